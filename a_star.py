@@ -1,17 +1,91 @@
+import copy, heapq, hashlib
 import numpy as np
-from matplotlib import pyplot as plt
+from cache import value_cache
+from eval_cache import canonical_string
+from lazy import lazy_program
+from fields import distance_fields, tied_ranks, rank_correlation
+from maps import load_map
+from instrument import null_stats
+from dsl import Plus, Minus, Times, Max, Min, Abs, compile_program, parse_program
+
+def pyplot():
+    # imported on first use, so headless runs never load matplotlib
+    from matplotlib import pyplot as plt
+    return plt
 
 class a_star:
-    def __init__(self, num_pairs, rotate_maze=False):
+    def __init__(self, num_pairs, rotate_maze=False, tie_break='random', value_cache_bytes=0,
+                 dedup_verify=False, cost_dtype=np.float32, compile_kernels=True, static_checks=True,
+                 seed=None, stats=None, eval_cache=None, evaluation='grid', lazy_probes=256,
+                 racing_rungs=(), racing_slack=1.5, prescreen=None, prescreen_cells=256, engine='heap'):
         self.num_pairs = num_pairs
         self.rotate_maze = rotate_maze
+        # which of several equally cheap cells to expand:
+        #   'random' - a random one, 'index' - the lowest flat index,
+        #   'g' - the one discovered furthest from the start, then the lowest flat index
+        assert tie_break in ['random', 'index', 'g']
+        self.tie_break = tie_break
+        # 'grid' interprets each heuristic over the whole map, 'lazy' only at the cells A* looks at (lazy.py)
+        assert evaluation in ['grid', 'lazy']
+        if evaluation == 'lazy' and value_cache_bytes:
+            raise ValueError('cached values are whole grids, lazy evaluation has no use for them')
+        self.evaluation = evaluation
+        # 'heap' runs the pairs one after another, 'batched' advances them together with array operations
+        # and finishes the last few one after another (run_pairs_batched)
+        assert engine in ['heap', 'batched']
+        if engine == 'batched' and (tie_break != 'index' or evaluation != 'grid'):
+            raise ValueError("the batched engine needs whole cost grids and lowest index ties, use tie_break='index' and evaluation='grid'")
+        self.engine = engine
+        # runs left when the batched engine stops advancing them together - below this many, a round of
+        # array operations costs more than expanding each run's cell from its heap
+        self.batch_tail = 32
+        # racing - after each rung's fraction of the runs, a candidate that took more than racing_slack times
+        # the best program's steps on those same runs is dropped without running the rest
+        assert all(0 < fraction < 1 for fraction in racing_rungs) and racing_slack >= 1
+        self.racing_rungs = sorted(racing_rungs)
+        self.racing_slack = racing_slack
+        # prescreening - once there is a best, a pair whose costs have a rank correlation of at most prescreen
+        # with the true goal distances (on up to prescreen_cells cells around the goal) is taken to use up
+        # the cutoff, and the candidate is stopped there without running A* on it
+        self.prescreen = prescreen
+        self.prescreen_cells = prescreen_cells
+        # open cells sampled at random for the duplicate check in lazy evaluation
+        assert lazy_probes >= 2
+        self.lazy_probes = lazy_probes
+        # dtype of the normalized cost buffers (float32 or float16 to cut memory traffic)
+        self.cost_dtype = cost_dtype
+        # evaluate heuristics through generated numpy kernels instead of walking the tree
+        self.compile_kernels = compile_kernels
+        # reject constant, overflowing and equivalent programs from their value ranges, before any grid
+        self.static_checks = static_checks
+        self.static_rejects = {}
+        # A* steps taken over every run, for throughput numbers
+        self.num_expansions = 0
+        # per-phase timers and counters (instrument.run_stats), nothing is recorded by default
+        self.stats = stats if stats is not None else null_stats()
         self.best_avg_steps = np.inf
         self.best_avg_steps_not_inf = False
-        self.costs_array_set = set()
-        self.rng = np.random.default_rng()
+        # cumulative steps of the best program after each run, what racing compares against
+        self.best_run_totals = None
+        # duplicate checking by digest of the whole cost tensor
+        # dedup_verify also keeps the tensor bytes to rule out hash collisions
+        self.dedup_verify = dedup_verify
+        self.costs_array_set = self.new_costs_array_set()
+        # seeds the pairs and random tie breaks - None draws fresh entropy
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # stacked values of programs added to the plist, so new programs only apply their top operation
+        if value_cache_bytes:
+            self.value_cache = value_cache(value_cache_bytes)
+        else:
+            self.value_cache = None
+        # results of evaluated programs kept on disk (eval_cache.eval_cache), shared between sessions and workers
+        if eval_cache is not None and tie_break == 'random':
+            raise ValueError("cached steps need to be reproducible, use tie_break='index' or 'g'")
+        self.eval_cache = eval_cache
+        self.eval_cache_hashes = {}
         
     def generate_maze(self, maze_size, cutoff, show_graphs=False):
-        import cv2
         (self.msy, self.msx) = maze_size
         
         maze = self.rng.random((self.msy,self.msx))
@@ -19,39 +93,46 @@ class a_star:
         maze[maze>cutoff] = 1
         maze[maze<=cutoff] = 0
         
-        kernel = np.ones((3,3), dtype=np.uint8)
-        operation = cv2.MORPH_CLOSE
-        self.maze = cv2.morphologyEx(maze, operation, kernel)
+        # morphological closing with a 3x3 kernel (dilate then erode), cells outside the maze ignored
+        self.maze = self.morph_3x3(self.morph_3x3(maze, np.maximum, -np.inf), np.minimum, np.inf)
         
         if show_graphs:
+            plt = pyplot()
             plt.imshow(self.maze)
             plt.show()
             plt.imshow(np.rot90(self.maze))
             plt.show()
     
-    def load_map_from_file(self, map_file_location, show_graphs=False):
-        with open(map_file_location, 'r') as f:
-            file_str = f.read()
-        
-        replace_list = [('T', '1 '), ('@', '1 '), ('.', '0 '), ('\n', '')]
-        
-        for replace_tuple in replace_list:
-            (old_str, new_str) = replace_tuple
-            file_str = file_str.replace(old_str, new_str)
-        
-        header = file_str[:file_str.find('map')+3]
-        self.msy = int(header[header.find('height')+7:header.find('width')])
-        self.msx = int(header[header.find('width')+6:header.find('map')])
-        
-        file_str = file_str[file_str.find('map')+3:]
-        
-        map_array_flat = np.fromstring(file_str, sep=' ')
-        
-        self.maze = map_array_flat.reshape((self.msy, self.msx))
+    def morph_3x3(self, maze, reduce, border):
+        padded = np.pad(maze, 1, constant_values=border)
+        out = padded[1:-1, 1:-1].copy()
+        for dy in range(3):
+            for dx in range(3):
+                reduce(out, padded[dy:dy+self.msy, dx:dx+self.msx], out=out)
+        return out
+    
+    def load_map_from_file(self, map_file_location, show_graphs=False, use_cache=True):
+        # uint8 maze, memory mapped from a cache next to the map file (see maps.py)
+        (header, self.maze) = load_map(map_file_location, use_cache=use_cache)
+        (self.msy, self.msx) = self.maze.shape
+        self.map_file_location = map_file_location if use_cache else None
         
         if show_graphs:
+            plt = pyplot()
             plt.imshow(self.maze)
             plt.show()
+    
+    def __getstate__(self):
+        # a cached maze is reopened by file rather than pickled, so worker processes map the same pages
+        state = self.__dict__.copy()
+        if state.get('map_file_location') is not None and isinstance(self.maze, np.memmap):
+            state['maze'] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'maze' in state and self.maze is None:
+            (_, self.maze) = load_map(self.map_file_location)
         
     def generate_start_goal_lists(self):
         start_idx = self.rng.choice(len(np.where(self.maze==0)[0]), size=self.num_pairs)
@@ -78,11 +159,37 @@ class a_star:
         print(self.starts)
         print(self.ends)
     
+    def save_pairs(self, pairs_location):
+        # (start,goal) pairs, so later runs can be scored on exactly the same ones
+        with open(pairs_location, 'wb') as f:
+            np.savez(f, starts=np.array(self.starts, dtype=np.int64).reshape(-1, 2),
+                     ends=np.array(self.ends, dtype=np.int64).reshape(-1, 2), map_shape=np.array((self.msy, self.msx)))
+    
+    def load_pairs(self, pairs_location):
+        # replaces generate_start_goal_lists - the map must already be loaded
+        with np.load(pairs_location) as pairs:
+            (starts, ends, map_shape) = (pairs['starts'], pairs['ends'], tuple(pairs['map_shape']))
+        if map_shape != (self.msy, self.msx):
+            raise ValueError(f'pairs are for a {map_shape} map, not {(self.msy, self.msx)}')
+        if np.any(self.maze[starts[:,0], starts[:,1]] != 0) or np.any(self.maze[ends[:,0], ends[:,1]] != 0):
+            raise ValueError('pairs start or end on a wall of this map')
+        self.starts = [(int(y), int(x)) for (y, x) in starts]
+        self.ends = [(int(y), int(x)) for (y, x) in ends]
+        self.num_pairs = len(self.starts)
+    
     def additional_gets(self):
         # state matrices
         self.state_x = np.vstack((np.arange(self.msx),) * self.msy)
         self.state_y = np.hstack((np.arange(self.msy).reshape(-1,1),) * self.msx)
         
+        # environment evaluating every (start,goal) pair at once - goals broadcast over the pair axis
+        self.stacked_env = {
+            'state_x': self.state_x,
+            'state_y': self.state_y,
+            'goal_x':  np.array([end[1] for end in self.ends]).reshape(-1,1,1),
+            'goal_y':  np.array([end[0] for end in self.ends]).reshape(-1,1,1),
+        }
+        
         # rotated (start,goal) pairs
         if self.rotate_maze:
             self.rotated_starts = []
@@ -99,88 +206,529 @@ class a_star:
                 self.rotated_starts.append(true_start)
                 self.rotated_ends.append(true_end)
         
-        # cutouts for duplicate checking
-        self.part_idx_dict = {}
-        for i in range(len(self.starts)):
-            for j,x in enumerate(['row', 'col']):
-                if x == 'row':
-                    maze_dim_size = self.msy
-                elif x == 'col':
-                    maze_dim_size = self.msx
-                if self.starts[i][j] < 2:
-                    self.part_idx_dict[f'{i}_{x}_start'] = self.starts[i][j]
-                    self.part_idx_dict[f'{i}_{x}_end'] = self.starts[i][j] + 5
-                elif self.starts[i][j] > maze_dim_size - 4:
-                    self.part_idx_dict[f'{i}_{x}_start'] = maze_dim_size - 6
-                    self.part_idx_dict[f'{i}_{x}_end'] = maze_dim_size - 1
-                else:
-                    self.part_idx_dict[f'{i}_{x}_start'] = self.starts[i][j] - 2
-                    self.part_idx_dict[f'{i}_{x}_end'] = self.starts[i][j] + 3
+        # value ranges of the variables for the static checks
+        self.var_bounds = {
+            'state_x': (0, self.msx - 1),
+            'state_y': (0, self.msy - 1),
+            'goal_x':  (min(end[1] for end in self.ends), max(end[1] for end in self.ends)),
+            'goal_y':  (min(end[0] for end in self.ends), max(end[0] for end in self.ends)),
+        }
+        
+        # walls, masked out of the duplicate check since A* never reads their costs
+        self.wall_mask = self.maze == 1
+        
+        # eval cache keys belong to the old pairs
+        self.eval_cache_hashes = {}
+        
+        # exact steps from every cell to each goal, -1 where the goal can't be reached
+        with self.stats.timer('distance_fields'):
+            self.goal_distances = distance_fields(self.maze, self.ends)
+        self.start_distances = [int(self.goal_distances[i][start]) for (i, start) in enumerate(self.starts)]
+        if self.prescreen is not None:
+            self.prepare_prescreen()
+        
+        # number of runs finished at each racing rung
+        num_runs = 2 * len(self.starts) if self.rotate_maze else len(self.starts)
+        self.racing_checks = {max(1, round(fraction * num_runs)) for fraction in self.racing_rungs} - {num_runs}
+        
+        if self.evaluation == 'lazy':
+            self.prepare_lazy()
+        
+        self.allocate_buffers()
+    
+    def prepare_lazy(self):
+        # flat cell coordinates and wall costs (9, open cells 0) of the padded map and of its rotation
+        cell_x = np.pad(self.state_x, 1)
+        cell_y = np.pad(self.state_y, 1)
+        walls = np.pad(np.where(self.wall_mask, 9, 0), 1, constant_values=9)
+        self.lazy_layouts = {}
+        for rotated in ([False, True] if self.rotate_maze else [False]):
+            layout = [np.rot90(array, k=1) if rotated else array for array in (cell_x, cell_y, walls)]
+            self.lazy_layouts[rotated] = tuple(array.ravel().tolist() for array in layout) + (layout[0].shape,)
+        self.lazy_goals = [(int(end[1]), int(end[0])) for end in self.ends]
+        
+        # open cells the duplicate check compares first, before the whole grid - programs built from small constants
+        # and the goal tend to differ near the edges and on the goals' rows and columns, so those are all kept,
+        # plus a fixed random sample (from its own generator, so self.rng draws are the same as grid evaluation)
+        probes = np.zeros((self.msy, self.msx), dtype=bool)
+        probes[:3] = probes[-3:] = True
+        probes[:, :3] = probes[:, -3:] = True
+        for (goal_y, goal_x) in self.ends:
+            probes[goal_y] = True
+            probes[:, goal_x] = True
+        (open_y, open_x) = np.nonzero(~self.wall_mask)
+        sample = np.random.default_rng(0).choice(len(open_y), min(self.lazy_probes, len(open_y)), replace=False)
+        probes[open_y[sample], open_x[sample]] = True
+        (probe_y, probe_x) = np.nonzero(probes & ~self.wall_mask)
+        self.probe_env = dict(self.stacked_env,
+                              state_x=probe_x.reshape(1,1,-1),
+                              state_y=probe_y.reshape(1,1,-1))
+    
+    def prepare_prescreen(self):
+        # per pair, flat padded indices of cells no further from the goal than the start, and their distance ranks
+        # - the cells a search on that pair should be drawn through
+        rng = np.random.default_rng(0)
+        self.screen_cells = []
+        self.screen_ranks = []
+        for (i, distances) in enumerate(self.goal_distances):
+            (cell_y, cell_x) = np.nonzero((distances >= 0) & (distances <= self.start_distances[i]))
+            if len(cell_y) > self.prescreen_cells:
+                sample = rng.choice(len(cell_y), self.prescreen_cells, replace=False)
+                (cell_y, cell_x) = (cell_y[sample], cell_x[sample])
+            self.screen_cells.append((cell_y + 1) * (self.msx + 2) + (cell_x + 1))
+            self.screen_ranks.append(tied_ranks(distances[cell_y, cell_x]))
+    
+    def optimal_steps(self):
+        # fewest steps a run of each pair can take - expanding just the cells of a shortest path, then the goal
+        return [distance + 1 for distance in self.start_distances]
+    
+    def optimal_avg_steps(self):
+        # the average steps run_a_star would give a perfect heuristic
+        runs_per_pair = 2 if self.rotate_maze else 1
+        return runs_per_pair * sum(self.optimal_steps()) / self.num_pairs
+    
+    def disconnected_pairs(self):
+        # pairs whose goal can't be reached from their start, which no heuristic would finish
+        return [i for (i, distance) in enumerate(self.start_distances) if distance < 0]
+    
+    def pair_hopeless(self, costs_array_padded_full, costs_array_idx):
+        # whether a pair's costs order the cells around its goal too unlike the true distances to be worth running
+        cells = self.screen_cells[costs_array_idx]
+        if isinstance(costs_array_padded_full, lazy_program):
+            (_, cell_cost, _) = costs_array_padded_full.run_costs(costs_array_idx, False)
+            values = np.array([cell_cost(idx) for idx in cells.tolist()])
+        else:
+            values = costs_array_padded_full[costs_array_idx].ravel()[cells]
+        return rank_correlation(values, self.screen_ranks[costs_array_idx]) <= self.prescreen
+    
+    def allocate_buffers(self):
+        # normalized costs of every pair, filled in place for each heuristic
+        # the padded buffer keeps its border of 9s, the unpadded one is a view into it
+        self.costs_buffer_padded = np.full((len(self.starts), self.msy+2, self.msx+2), 9, dtype=self.cost_dtype)
+        self.costs_buffer = self.costs_buffer_padded[:, 1:-1, 1:-1]
+        # float16 overflows past 65504 before the divide, so narrower dtypes are normalized in float32 and cast after
+        if np.dtype(self.cost_dtype).itemsize < 4:
+            self.costs_scratch = np.empty(self.costs_buffer.shape, dtype=np.float32)
+        else:
+            self.costs_scratch = None
 
     def run_a_star(self, heuristic, compare_normalized_costs=False, update_best=True, show_graphs=False):
         # have input for heuristic
         # have this function be for one A* run, separate function to call them all
-        total_num_steps = 0
+        if self.eval_cache is not None and update_best and not show_graphs:
+            return self.run_a_star_cached(heuristic, compare_normalized_costs)
+        if update_best and not self.passes_static_checks(heuristic, compare_normalized_costs):
+            return np.inf, False, None
+        costs = self.get_costs(heuristic, compare_normalized_costs, show_graphs=show_graphs)
+        if costs is None:
+            return np.inf, False, None
+        (costs_array_padded_full, costs_key) = costs
         
-        # generate 3D array of costs
-        for i in range(len(self.starts)):
-            env = {
-                'state_x': self.state_x,
-                'state_y': self.state_y,
-                'goal_x':  self.ends[i][1],
-                'goal_y':  self.ends[i][0],
-            }
-            
-            costs_array = heuristic.interpret(env)
-            costs_array_normalized = costs_array - np.min(costs_array)
-            if np.max(costs_array_normalized) != 0:
-                costs_array_normalized = costs_array_normalized / np.max(costs_array_normalized)
-            try:
-                if not costs_array.shape:
-                    return np.inf, False, None
-            except AttributeError:
+        # check if costs array is a copy
+        if update_best:
+            if self.is_duplicate_costs(costs_key):
                 return np.inf, False, None
-            
-            r1 = self.part_idx_dict[f'{i}_row_start']
-            r2 = self.part_idx_dict[f'{i}_row_end']
-            c1 = self.part_idx_dict[f'{i}_col_start']
-            c2 = self.part_idx_dict[f'{i}_col_end']
-            
+        
+        with self.stats.timer('frontier'):
+            pair_steps = self.run_pairs(costs_array_padded_full, show_graphs=show_graphs)
+        self.count_outcome(pair_steps)
+        avg_steps, add_to_plist, num_iters = self.score_pair_steps(pair_steps, update_best=update_best)
+        if add_to_plist and update_best:
+            self.cache_values(heuristic)
+        return avg_steps, add_to_plist, num_iters
+    
+    def run_a_star_cached(self, heuristic, compare_normalized_costs):
+        # run_a_star through the eval cache - A* only runs for programs it doesn't hold,
+        # and the duplicate check and score are applied to the stored steps
+        if not self.passes_static_checks(heuristic, compare_normalized_costs):
+            return np.inf, False, None
+        (found, result) = self.cached_result(heuristic, compare_normalized_costs)
+        if found:
+            if result is None or self.is_duplicate_costs(result[0]):
+                return np.inf, False, None
+        else:
+            costs = self.get_costs(heuristic, compare_normalized_costs)
+            if costs is None:
+                self.store_result(heuristic, compare_normalized_costs, None)
+                return np.inf, False, None
+            (costs_array_padded_full, costs_key) = costs
+            # checked before A* runs, like run_a_star - nothing is stored for a duplicate, its steps were never needed
+            if self.is_duplicate_costs(costs_key):
+                return np.inf, False, None
+            result = self.run_costs(heuristic, costs_array_padded_full, costs_key)
+            self.store_result(heuristic, compare_normalized_costs, result)
+        pair_steps = result[1]
+        self.count_outcome(pair_steps)
+        return self.score_pair_steps(pair_steps)
+    
+    def evaluate_pairs(self, heuristic, compare_normalized_costs=False, costs=None):
+        # run_a_star without touching the duplicate set or the best average
+        # lets a different process decide duplicates and scores afterwards
+        # costs from program_costs are run as they are, without the checks and working out again
+        if costs is None:
+            if not self.passes_static_checks(heuristic, compare_normalized_costs):
+                return None
+            if self.eval_cache is not None:
+                (found, result) = self.cached_result(heuristic, compare_normalized_costs)
+                if found:
+                    return result
+            costs = self.get_costs(heuristic, compare_normalized_costs)
+        
+        result = None if costs is None else self.run_costs(heuristic, *costs)
+        if self.eval_cache is not None:
+            self.store_result(heuristic, compare_normalized_costs, result)
+        return result
+    
+    def program_costs_key(self, heuristic, compare_normalized_costs=False):
+        # the costs key evaluate_pairs would return, without running A* - None for a program it rejects
+        # lets a different process check duplicates before any A* is run for a program
+        return self.program_costs(heuristic, compare_normalized_costs)[0]
+    
+    def program_costs(self, heuristic, compare_normalized_costs=False):
+        # (costs_key, costs) - costs are what evaluate_pairs runs A* on, None when the key came from the eval cache
+        # they sit in the shared buffers, so they hold until the next program's costs are worked out
+        if not self.passes_static_checks(heuristic, compare_normalized_costs):
+            return (None, None)
+        if self.eval_cache is not None:
+            (found, result) = self.cached_result(heuristic, compare_normalized_costs)
+            if found:
+                return (None if result is None else result[0], None)
+        costs = self.get_costs(heuristic, compare_normalized_costs)
+        return (None, None) if costs is None else (costs[1], costs)
+    
+    def run_costs(self, heuristic, costs_array_padded_full, costs_key):
+        # (costs_key, pair_steps) of a heuristic whose costs are worked out
+        with self.stats.timer('frontier'):
+            pair_steps = self.run_pairs(costs_array_padded_full)
+        # whether it reaches the plist is decided elsewhere, so cache anything that could
+        if pair_steps[-1][1] != 'over':
+            self.cache_values(heuristic)
+        return (costs_key, pair_steps)
+    
+    def cached_result(self, heuristic, compare_normalized_costs):
+        # (found, result) from the eval cache, for runs under the current cutoff
+        (found, result) = self.eval_cache.get(*self.eval_cache_key(heuristic, compare_normalized_costs), self.max_total_steps())
+        self.stats.count('eval_cache_hits' if found else 'eval_cache_misses')
+        return (found, result)
+    
+    def store_result(self, heuristic, compare_normalized_costs, result):
+        # a raced result depends on the best program's runs, not only the cutoff, so it isn't kept
+        if not self.is_raced(result):
+            self.eval_cache.put(*self.eval_cache_key(heuristic, compare_normalized_costs), result, self.max_total_steps())
+    
+    def is_raced(self, result):
+        return result is not None and result[1][-1][1] == 'raced'
+    
+    def eval_cache_key(self, heuristic, compare_normalized_costs):
+        # (map hash, pairs and settings hash, canonical program) - the hashes are worked out once per pair set
+        if compare_normalized_costs not in self.eval_cache_hashes:
+            self.eval_cache_hashes[compare_normalized_costs] = (self.maze_digest(), self.setup_digest(compare_normalized_costs))
+        return self.eval_cache_hashes[compare_normalized_costs] + (canonical_string(heuristic),)
+    
+    def passes_static_checks(self, heuristic, compare_normalized_costs=False):
+        if not self.static_checks:
+            return True
+        with self.stats.timer('static_checks'):
+            reason = self.static_reject(heuristic, compare_normalized_costs)
+        if reason is None:
+            return True
+        self.static_rejects[reason] = self.static_rejects.get(reason, 0) + 1
+        self.stats.count('static_rejected')
+        return False
+    
+    def count_outcome(self, pair_steps):
+        # cut short by the best average, dropped at a racing rung, over the step limit, or run on every pair
+        outcome = pair_steps[-1][1]
+        if outcome == 'cut':
+            self.stats.count('early_terminated')
+        elif outcome == 'raced':
+            self.stats.count('raced')
+        elif outcome == 'screened':
+            self.stats.count('screened')
+        elif outcome == 'over':
+            self.stats.count('over_step_limit')
+        else:
+            self.stats.count('fully_evaluated')
+    
+    def static_reject(self, heuristic, compare_normalized_costs=False):
+        # why a heuristic can be rejected before evaluation, or None
+        # equivalent forms only cost the same once normalized, so raw costs comparisons keep them
+        if heuristic.isConstant():
+            return 'constant'
+        (lo, hi) = heuristic.getRange(self.var_bounds)
+        if lo == hi:
+            return 'constant'
+        # past this, integer programs can wrap around and floats lose the precision normalization needs
+        if max(abs(lo), abs(hi)) > 2**62:
+            return 'overflow'
+        if compare_normalized_costs and self.equivalent_program(heuristic) is not None:
+            return 'equivalent'
+        return None
+    
+    def equivalent_program(self, heuristic):
+        # an already evaluated program that gives the same normalized costs, or None
+        # normalization removes any per-pair offset and positive scale
+        if isinstance(heuristic, Abs):
+            # abs of something that is never negative - the inner program is generated alongside it
+            if heuristic.value.getRange(self.var_bounds)[0] >= 0:
+                return heuristic.value
+            return None
+        if not isinstance(heuristic, (Plus, Minus, Times, Max, Min)):
+            return None
+        
+        (left, right) = (heuristic.left, heuristic.right)
+        if isinstance(heuristic, Minus):
+            orders = [(left, right)]
+        else:
+            orders = [(left, right), (right, left)]
+        for (program, other) in orders:
+            # single variables are never evaluated on their own
+            if program.getSize() == 1:
+                continue
+            if isinstance(heuristic, (Plus, Minus)) and other.isConstant():
+                return program
+            if isinstance(heuristic, Times) and other.isConstant() and other.getRange(self.var_bounds)[0] > 0:
+                return program
+            # max / min that always pick the same side
+            (program_lo, program_hi) = program.getRange(self.var_bounds)
+            (other_lo, other_hi) = other.getRange(self.var_bounds)
+            if isinstance(heuristic, Max) and program_lo >= other_hi:
+                return program
+            if isinstance(heuristic, Min) and program_hi <= other_lo:
+                return program
+        return None
+    
+    def cache_values(self, heuristic):
+        if self.value_cache is not None and self.evaluation == 'grid':
+            self.value_cache.put(heuristic.toString(), self.last_values)
+    
+    def copy_for_worker(self):
+        # shares the maze, state matrices and pairs, but not the duplicate set or cached values
+        evaluator = copy.copy(self)
+        evaluator.costs_array_set = self.new_costs_array_set()
+        # counts made in a worker never reach this process - the parent counts what it merges
+        evaluator.stats = null_stats()
+        if self.value_cache is not None:
+            evaluator.value_cache = value_cache(self.value_cache.max_bytes)
+        evaluator.allocate_buffers()
+        return evaluator
+    
+    def checkpoint_state(self):
+        # what a resumed search needs - the pairs, the duplicate set and the best score, not the map itself
+        return {
+            'maze_digest': self.maze_digest(),
+            'starts': [(int(y), int(x)) for (y, x) in self.starts],
+            'ends': [(int(y), int(x)) for (y, x) in self.ends],
+            'costs_array_set': self.costs_array_set,
+            # the duplicate set's form depends on both
+            'dedup_setup': (self.dedup_verify, self.evaluation),
+            'best_avg_steps': self.best_avg_steps,
+            'best_avg_steps_not_inf': self.best_avg_steps_not_inf,
+            'best_run_totals': self.best_run_totals,
+            'static_rejects': self.static_rejects,
+            'rng_state': self.rng.bit_generator.state,
+        }
+    
+    def maze_digest(self):
+        return hashlib.blake2b(np.ascontiguousarray(self.maze, dtype=np.uint8).tobytes(), digest_size=16).digest()
+    
+    def setup_digest(self, compare_normalized_costs):
+        # everything besides the map that a program's steps depend on - the pairs and how costs are built and searched
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr([(int(y), int(x)) for (y, x) in self.starts]).encode())
+        digest.update(repr([(int(y), int(x)) for (y, x) in self.ends]).encode())
+        # dedup_verify changes the form of the stored costs keys
+        digest.update(repr((self.rotate_maze, self.tie_break, np.dtype(self.cost_dtype).name, self.dedup_verify,
+                            self.static_checks, compare_normalized_costs, self.evaluation, self.lazy_probes,
+                            self.prescreen, self.prescreen_cells)).encode())
+        return digest.digest()
+    
+    def restore_checkpoint_state(self, state):
+        # the map must already be loaded - the pairs and everything built from them are replaced
+        if self.maze_digest() != state['maze_digest']:
+            raise ValueError('checkpoint was taken on a different map')
+        if state['dedup_setup'] != (self.dedup_verify, self.evaluation):
+            raise ValueError('checkpoint was taken with a different dedup_verify or evaluation')
+        self.starts = state['starts']
+        self.ends = state['ends']
+        self.num_pairs = len(self.starts)
+        # cached values belong to the old goals
+        if self.value_cache is not None:
+            self.value_cache.clear()
+        self.costs_array_set = state['costs_array_set']
+        self.best_avg_steps = state['best_avg_steps']
+        self.best_avg_steps_not_inf = state['best_avg_steps_not_inf']
+        self.best_run_totals = state['best_run_totals']
+        self.static_rejects = state['static_rejects']
+        self.rng.bit_generator.state = state['rng_state']
+        self.additional_gets()
+    
+    def reset_search_state(self):
+        # forget the best score, seen cost tensors and static rejects of a previous search,
+        # so a loaded map and its pairs can be reused for another one
+        self.best_avg_steps = np.inf
+        self.best_avg_steps_not_inf = False
+        self.best_run_totals = None
+        self.costs_array_set = self.new_costs_array_set()
+        self.static_rejects = {}
+        if self.value_cache is not None:
+            self.value_cache.clear()
+    
+    def new_costs_array_set(self):
+        if self.dedup_verify or self.evaluation == 'lazy':
+            return {}
+        return set()
+    
+    def costs_key(self, costs_array):
+        # quantized to float32, so tiny rounding differences don't keep equivalent programs apart
+        costs_bytes = np.ascontiguousarray(costs_array, dtype=np.float32).tobytes()
+        digest = hashlib.blake2b(costs_bytes, digest_size=16).digest()
+        if self.dedup_verify:
+            return digest, costs_bytes
+        return digest
+    
+    def is_duplicate_costs(self, costs_key):
+        with self.stats.timer('dedup'):
+            duplicate = self.check_duplicate_costs(costs_key)
+        if duplicate:
+            self.stats.count('duplicate_costs')
+        return duplicate
+    
+    def check_duplicate_costs(self, costs_key):
+        if self.evaluation == 'lazy':
+            return self.check_duplicate_lazy_costs(costs_key)
+        if self.dedup_verify:
+            (digest, costs_bytes) = costs_key
+            same_digest = self.costs_array_set.setdefault(digest, [])
+            if costs_bytes in same_digest:
+                return True
+            same_digest.append(costs_bytes)
+            return False
+        
+        if costs_key in self.costs_array_set:
+            return True
+        self.costs_array_set.add(costs_key)
+        return False
+    
+    def check_duplicate_lazy_costs(self, costs_key):
+        # a lazy key only covers the probe cells, so programs that match there are told apart on the whole grid
+        # probe key -> [[program, grid costs key or None until a later program's probes match]]
+        (probe_key, program, compare_normalized_costs) = costs_key
+        same_probes = self.costs_array_set.get(probe_key)
+        if same_probes is None:
+            self.costs_array_set[probe_key] = [[program, None]]
+            return False
+        grid_key = self.grid_costs_key(program, compare_normalized_costs)
+        for entry in same_probes:
+            if entry[1] is None:
+                entry[1] = self.grid_costs_key(entry[0], compare_normalized_costs)
+            if grid_key is not None and entry[1] == grid_key:
+                return True
+        same_probes.append([program, grid_key])
+        return False
+    
+    def grid_costs_key(self, program, compare_normalized_costs):
+        # costs key grid evaluation gives a program's toString(), None when the grid rejects it
+        costs = self.get_costs_arrays(parse_program(program), compare_normalized_costs)
+        return None if costs is None else costs[1]
+    
+    def get_costs(self, heuristic, compare_normalized_costs=False, show_graphs=False):
+        # (costs, costs_key) for run_pairs, or None for an invalid program - graphs need the whole grid
+        if self.evaluation == 'lazy' and not show_graphs:
+            return self.get_lazy_costs(heuristic, compare_normalized_costs)
+        return self.get_costs_arrays(heuristic, compare_normalized_costs)
+    
+    def get_lazy_costs(self, heuristic, compare_normalized_costs=False):
+        # a lazy_program working out costs as A* reaches cells, keyed for duplicates by the probe cells' values
+        # and the program, which check_duplicate_lazy_costs evaluates on the whole grid when probe values match
+        with self.stats.timer('interpret'):
+            if self.compile_kernels:
+                probe_values = compile_program(heuristic)(self.probe_env)
+            else:
+                probe_values = heuristic.interpret(self.probe_env)
+            # value range of each pair over the whole map, standing in for the grid's minimum and maximum
+            ranges = [heuristic.getRange(dict(self.var_bounds, goal_x=(goal_x, goal_x), goal_y=(goal_y, goal_y)))
+                      for (goal_x, goal_y) in self.lazy_goals]
+        
+        # constant, or only depends on the goal
+        num_probes = self.probe_env['state_x'].shape[-1]
+        if np.shape(probe_values)[-1:] != (num_probes,):
+            self.stats.count('invalid_costs')
+            return None
+        # the range lazy costs are normalized by has to be finite and within float precision
+        if not all(max(abs(lo), abs(hi)) <= 2**62 for (lo, hi) in ranges):
+            print('max cost exceeded')
+            self.stats.count('invalid_costs')
+            return None
+        
+        with self.stats.timer('costs_key'):
+            probe_values = np.broadcast_to(probe_values, (len(self.starts), 1, num_probes)).astype(np.float64)
             if compare_normalized_costs:
-                costs_part = costs_array_normalized[r1:r2, c1:c2]
+                probe_values -= np.min(probe_values, axis=(1,2), keepdims=True)
+                probe_max = np.max(probe_values, axis=(1,2), keepdims=True)
+                np.divide(probe_values, probe_max, out=probe_values, where=probe_max != 0)
+            costs_key = (self.costs_key(probe_values), heuristic.toString(), compare_normalized_costs)
+        
+        return lazy_program(heuristic, self.lazy_goals, ranges, self.lazy_layouts), costs_key
+    
+    def get_costs_arrays(self, heuristic, compare_normalized_costs=False):
+        # generate 3D array of costs, all (start,goal) pairs at once
+        with self.stats.timer('interpret'):
+            if self.value_cache is not None:
+                costs_array_full = heuristic.interpret_cached(self.stacked_env, self.value_cache)
+            elif self.compile_kernels:
+                costs_array_full = compile_program(heuristic)(self.stacked_env)
             else:
-                costs_part = costs_array[r1:r2, c1:c2]
+                costs_array_full = heuristic.interpret(self.stacked_env)
+        
+        # constant, or only depends on the goal
+        if np.shape(costs_array_full)[-2:] != (self.msy, self.msx):
+            self.stats.count('invalid_costs')
+            return None
+        self.last_values = costs_array_full
+        costs_array_full = np.broadcast_to(costs_array_full, (len(self.starts), self.msy, self.msx))
+        
+        # normalize each pair into the preallocated buffer
+        with self.stats.timer('normalize'):
+            costs_array_normalized = self.costs_buffer if self.costs_scratch is None else self.costs_scratch
+            np.subtract(costs_array_full, np.min(costs_array_full, axis=(1,2), keepdims=True),
+                        out=costs_array_normalized, casting='unsafe')
+            costs_array_max = np.max(costs_array_normalized, axis=(1,2), keepdims=True)
+            np.divide(costs_array_normalized, costs_array_max, out=costs_array_normalized, where=costs_array_max != 0)
             
-            if i == 0:
-                costs_array_full = costs_array_normalized
-                costs_part_full = costs_part
-            elif i == 1:
-                costs_array_full = np.stack((costs_array_full, costs_array_normalized), axis=0)
-                costs_part_full = np.stack((costs_part_full, costs_part), axis=0)
-            else:
-                costs_array_full = np.concatenate((costs_array_full, np.expand_dims(costs_array_normalized, axis=0)), axis=0)
-                costs_part_full = np.concatenate((costs_part_full, np.expand_dims(costs_part, axis=0)), axis=0)
-                
-        # make sure max of costs array doesn't exceed 555,555,555
-        # can change stuff to np.inf and use nanmax / nanmin
-        if np.max(costs_array_full) > 1:
+            # make sure max of costs array doesn't exceed 555,555,555
+            # can change stuff to np.inf and use nanmax / nanmin
+            # (written so NaN costs are caught too)
+            max_cost_exceeded = not np.max(costs_array_normalized) <= 1
+            if not max_cost_exceeded:
+                if self.costs_scratch is not None:
+                    self.costs_buffer[...] = self.costs_scratch
+                self.costs_buffer[:, self.wall_mask] = 9
+        if max_cost_exceeded:
             print('max cost exceeded')
-            return np.inf, False, None
+            self.stats.count('invalid_costs')
+            return None
         
-        # check if costs array is a copy
-        if update_best:
-            if tuple(costs_part_full.flatten()) in self.costs_array_set:
-                return np.inf, False, None
+        with self.stats.timer('costs_key'):
+            if compare_normalized_costs:
+                # padded buffer is contiguous and its border is constant
+                costs_key = self.costs_key(self.costs_buffer_padded)
             else:
-                self.costs_array_set.add(tuple(costs_part_full.flatten()))
-
+                costs_key = self.costs_key(np.where(self.wall_mask, 0, costs_array_full))
+        
+        return self.costs_buffer_padded, costs_key
+    
+    def pair_runs(self):
+        # (costs array index, rotated, true start, true end) for every A* run
+        # true start and end account for padding and rotation
+        runs = []
+        
         # number of (start,goal) pairs
         if self.rotate_maze:
             pair_num = 2 * len(self.starts)
         else:
             pair_num = len(self.starts)
         
-        # actually running A*
         for i in range(pair_num):
             # which index in cost array to use
             if self.rotate_maze:
@@ -188,10 +736,6 @@ class a_star:
             else:
                 costs_array_idx = i
             
-            costs_array = costs_array_full[costs_array_idx,:,:]
-            costs_array[self.maze==1] = 9
-            costs_array_padded = np.pad(costs_array, 1, mode='constant', constant_values=9)
-            
             # whether the maze is rotated
             if self.rotate_maze:
                 if i % 2 == 0:
@@ -201,57 +745,397 @@ class a_star:
             else:
                 rotated = False
                 
-            # true start and end, accounting for padding and rotation
             if rotated:
-                costs_array_padded = np.rot90(costs_array_padded, k=1)
-                
                 true_start = (self.rotated_starts[costs_array_idx][0]+1, self.rotated_starts[costs_array_idx][1]+1)
                 true_end = (self.rotated_ends[costs_array_idx][0]+1, self.rotated_ends[costs_array_idx][1]+1)
-                
-                true_msy = self.msx + 2
-                true_msx = self.msy + 2
-                
             else:
                 true_start = (self.starts[costs_array_idx][0]+1, self.starts[costs_array_idx][1]+1)
                 true_end = (self.ends[costs_array_idx][0]+1, self.ends[costs_array_idx][1]+1)
-                
-                true_msy = self.msy + 2
-                true_msx = self.msx + 2
-            
-            revealed_array = np.ones(costs_array_padded.shape) * 9
             
-            revealed_array[true_start] = 7
-            modifiable_costs_array_padded = np.copy(costs_array_padded)
-            
-            num_steps = 0
-            while True:
-                num_steps += 1
-                min_idx = self.rng.choice(np.where(revealed_array.flatten() == revealed_array.flatten().min())[0])
-                row = min_idx // true_msx
-                col = min_idx % true_msx
-                if true_end == (row,col):
+            runs.append((costs_array_idx, rotated, true_start, true_end))
+        return runs
+    
+    def run_pairs(self, costs_array_padded_full, show_graphs=False):
+        # runs A* over every (start,goal) pair until one fails or the cutoff hits
+        # returns (num_steps, outcome) per pair run, outcome is 'goal', 'over' or 'cut'
+        # or 'raced' when racing dropped it - during the run, or with 0 steps after a rung's last run
+        # - or 'screened', with 0 steps, for a pair prescreening stopped it at
+        # costs_array_padded_full is the normalized grid of every pair, or a lazy_program
+        if self.engine == 'batched' and not show_graphs:
+            pair_steps = self.run_pairs_batched(costs_array_padded_full)
+            self.count_expansions(pair_steps)
+            return pair_steps
+        
+        total_num_steps = 0
+        pair_steps = []
+        # only worth it while a cutoff would stop a hopeless run - otherwise it could still become the best
+        screen = self.prescreen is not None and self.best_avg_steps_not_inf
+        hopeless = {}
+        
+        # actually running A*
+        for (costs_array_idx, rotated, true_start, true_end) in self.pair_runs():
+            if screen:
+                if costs_array_idx not in hopeless:
+                    with self.stats.timer('prescreen'):
+                        hopeless[costs_array_idx] = self.pair_hopeless(costs_array_padded_full, costs_array_idx)
+                if hopeless[costs_array_idx]:
+                    pair_steps.append((0, 'screened'))
                     break
-                modifiable_costs_array_padded[row,col] = 7
-                revealed_array[row-1:row+2,col-1:col+2] = modifiable_costs_array_padded[row-1:row+2,col-1:col+2]
-                if num_steps > true_msy*true_msx:
-                    print(num_steps)
-                    return np.inf, None, None
-                if self.best_avg_steps_not_inf:
-                    if total_num_steps + num_steps > self.best_avg_steps * self.num_pairs:
-                        return np.inf, True, costs_array_idx
+            if isinstance(costs_array_padded_full, lazy_program):
+                (costs, cell_cost, costs_shape) = costs_array_padded_full.run_costs(costs_array_idx, rotated)
+            else:
+                costs_array_padded = costs_array_padded_full[costs_array_idx,:,:]
+                if rotated:
+                    costs_array_padded = np.rot90(costs_array_padded, k=1)
+                (costs, costs_shape) = (costs_array_padded.ravel().tolist(), costs_array_padded.shape)
+                cell_cost = costs.__getitem__
+            
+            num_steps, outcome, closed = self.expand_frontier(costs, cell_cost, costs_shape, true_start, true_end, total_num_steps,
+                                                              self.race_limit(len(pair_steps)))
+            pair_steps.append((num_steps, outcome))
+            if outcome != 'goal':
+                break
             
             if show_graphs:
+                modifiable_costs_array_padded = np.copy(costs_array_padded)
+                modifiable_costs_array_padded[closed] = 7
                 modifiable_costs_array_padded[true_start] = 5 # blue
                 modifiable_costs_array_padded[true_end] = 3 # purple
                 
+                plt = pyplot()
                 plt.imshow(modifiable_costs_array_padded)
                 plt.show()
             
             total_num_steps += num_steps
+            # a run's last step isn't checked against the limit, so a rung can still be missed by one
+            if len(pair_steps) in self.racing_checks and total_num_steps > self.race_limit(len(pair_steps) - 1):
+                pair_steps.append((0, 'raced'))
+                break
+        
+        self.count_expansions(pair_steps)
+        return pair_steps
+    
+    def run_pairs_batched(self, costs_array_padded_full):
+        # the pair steps of run_pairs, with the runs advanced together one expansion per round
+        # a run in the batch ignores the cutoff and racing - resolve_run works out from where it stopped
+        # what run_pairs would have made of it. runs the cutoff is sure to stop the candidate before are retired,
+        # and once batch_tail runs are left, the ones still needed are run one after another like run_pairs
+        runs = self.pair_runs()
+        max_total_steps = self.max_total_steps()
+        # prescreening stops at the first hopeless pair, so only the runs before it are batched
+        screened = False
+        if self.prescreen is not None and self.best_avg_steps_not_inf:
+            hopeless = {}
+            for (r, (costs_array_idx, _, _, _)) in enumerate(runs):
+                if costs_array_idx not in hopeless:
+                    with self.stats.timer('prescreen'):
+                        hopeless[costs_array_idx] = self.pair_hopeless(costs_array_padded_full, costs_array_idx)
+                if hopeless[costs_array_idx]:
+                    (runs, screened) = (runs[:r], True)
+                    break
+        (num_steps, finished, states) = self.advance_batch(costs_array_padded_full, runs, max_total_steps)
+        max_steps = costs_array_padded_full.shape[1] * costs_array_padded_full.shape[2]
+        
+        total_num_steps = 0
+        pair_steps = []
+        for (r, (costs_array_idx, rotated, true_start, true_end)) in enumerate(runs):
+            race_limit = self.race_limit(len(pair_steps))
+            if r in finished or num_steps[r] >= self.run_limit(total_num_steps, race_limit, max_total_steps)[0]:
+                step = self.resolve_run(finished.get(r), total_num_steps, race_limit, max_total_steps, max_steps)
+            else:
+                costs_array_padded = costs_array_padded_full[costs_array_idx,:,:]
+                if rotated:
+                    costs_array_padded = np.rot90(costs_array_padded, k=1)
+                costs = costs_array_padded.ravel().tolist()
+                # picks up where the batch left it, or from the start for a run it retired
+                step = self.expand_frontier(costs, costs.__getitem__, costs_array_padded.shape, true_start, true_end,
+                                            total_num_steps, race_limit, resume=states.get(r))[:2]
+            pair_steps.append(step)
+            if step[1] != 'goal':
+                return pair_steps
+            total_num_steps += step[0]
+            if len(pair_steps) in self.racing_checks and total_num_steps > self.race_limit(len(pair_steps) - 1):
+                pair_steps.append((0, 'raced'))
+                return pair_steps
+        if screened:
+            pair_steps.append((0, 'screened'))
+        return pair_steps
+    
+    def advance_batch(self, costs_array_padded_full, runs, max_total_steps):
+        # (steps taken by each run, run -> (steps, 'goal', 'stuck' or 'over') of the runs that stopped by themselves,
+        #  run -> expand_frontier resume state of the runs still going when the batch got down to batch_tail)
+        # every run keeps a revealed array - open cells hold their cost, closed cells 7, walls and unrevealed
+        # cells 9 - with the minimum of each row, so a round only rescans the rows it revealed
+        # the lowest row, then the lowest column among tied minima, is the lowest flat index, like tie_break='index'
+        num_runs = len(runs)
+        num_steps = np.zeros(num_runs, dtype=np.int64)
+        finished = {}
+        if num_runs <= self.batch_tail:
+            return (num_steps, finished, {})
+        (true_msy, true_msx) = costs_array_padded_full.shape[1:]
+        max_steps = true_msy * true_msx
+        
+        # rotated runs share a square layout, which keeps row-major tie order
+        if self.rotate_maze:
+            stacked_shape = (num_runs, max(true_msy, true_msx), max(true_msy, true_msx))
+        else:
+            stacked_shape = (num_runs, true_msy, true_msx)
+        (_, stacked_msy, stacked_msx) = stacked_shape
+        run_cells = stacked_msy * stacked_msx
+        modifiable_costs = np.full(stacked_shape, 9, dtype=costs_array_padded_full.dtype)
+        for (r, (costs_array_idx, rotated, _, _)) in enumerate(runs):
+            costs_array_padded = costs_array_padded_full[costs_array_idx,:,:]
+            if rotated:
+                costs_array_padded = np.rot90(costs_array_padded, k=1)
+            modifiable_costs[r, :costs_array_padded.shape[0], :costs_array_padded.shape[1]] = costs_array_padded
+        revealed = np.full(stacked_shape, 9, dtype=modifiable_costs.dtype)
+        for (r, (_, _, true_start, _)) in enumerate(runs):
+            revealed[r][true_start] = 7
+        goal_cells = np.array([true_end[0] * stacked_msx + true_end[1] for (_, _, _, true_end) in runs])
+        row_mins = revealed.min(axis=2)
+        row_argmins = revealed.argmin(axis=2)
+        # flat views - a cell is run * run_cells + row * stacked_msx + column, a row is run * stacked_msy + row
+        (flat_modifiable, flat_revealed) = (modifiable_costs.reshape(-1), revealed.reshape(-1))
+        revealed_rows = revealed.reshape(-1, stacked_msx)
+        (flat_row_mins, flat_row_argmins) = (row_mins.reshape(-1), row_argmins.reshape(-1))
+        block_offsets = np.array([dy * stacked_msx + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+        row_offsets = np.array([-1, 0, 1])
+        
+        # every run still in the batch has taken one step per round
+        active = np.arange(num_runs)
+        num_rounds = 0
+        while len(active) > self.batch_tail:
+            num_rounds += 1
+            active_row_mins = row_mins[active]
+            rows = active_row_mins.argmin(axis=1)
+            min_vals = active_row_mins[np.arange(len(active)), rows]
+            cells = rows * stacked_msx + row_argmins[active, rows]
+            at_goal = cells == goal_cells[active]
+            # nothing open - expand_frontier's heap is empty
+            stuck = (min_vals >= 7) & ~at_goal if num_rounds > 1 else np.zeros_like(at_goal)
+            stopped = at_goal | stuck
+            if stopped.any():
+                for (kind, stops) in (('goal', at_goal), ('stuck', stuck)):
+                    for r in active[stops].tolist():
+                        finished[r] = (num_rounds, kind)
+                num_steps[active[stopped]] = num_rounds
+                (active, rows, cells) = (active[~stopped], rows[~stopped], cells[~stopped])
+                if len(active) == 0:
+                    break
+            
+            expanded = active * run_cells + cells
+            flat_modifiable[expanded] = 7
+            block = expanded[:,None] + block_offsets
+            flat_revealed[block] = flat_modifiable[block]
+            changed = (active * stacked_msy + rows)[:,None] + row_offsets
+            changed_rows = revealed_rows[changed]
+            flat_row_mins[changed] = changed_rows.min(axis=2)
+            flat_row_argmins[changed] = changed_rows.argmin(axis=2)
+            
+            if num_rounds > max_steps:
+                for r in active.tolist():
+                    finished[r] = (num_rounds, 'over')
+                num_steps[active] = num_rounds
+                active = active[:0]
+            
+            # a run is only reached when every run before it reaches its goal within the cutoff,
+            # which they can't once their steps so far add up to more than it
+            if max_total_steps < np.inf:
+                num_steps[active] = num_rounds
+                steps_before = np.cumsum(num_steps) - num_steps
+                retired = steps_before[active] > max_total_steps + 1
+                if retired.any():
+                    active = active[~retired]
+        num_steps[active] = num_rounds
+        self.stats.count('batch_rounds', num_rounds)
+        
+        # the open cells of a revealed array are the heap, and ties by lowest flat index pop in the same order
+        # (a run that hasn't taken a step starts afresh - its start is revealed as closed)
+        states = {}
+        for r in active[num_steps[active] > 0].tolist():
+            run_shape = costs_array_padded_full.shape[:0:-1] if runs[r][1] else costs_array_padded_full.shape[1:]
+            run_revealed = revealed[r, :run_shape[0], :run_shape[1]].ravel()
+            open_idx = np.flatnonzero(run_revealed < 7)
+            open_heap = list(zip(run_revealed[open_idx].tolist(), open_idx.tolist()))
+            heapq.heapify(open_heap)
+            seen = bytearray((run_revealed < 9).astype(np.uint8).tobytes())
+            closed = (modifiable_costs[r, :run_shape[0], :run_shape[1]] == 7).ravel()
+            states[r] = (int(num_steps[r]), seen, open_heap, closed)
+        return (num_steps, finished, states)
+    
+    def run_limit(self, total_num_steps, race_limit, max_total_steps):
+        # (first step of a run at which expand_frontier stops it, 'cut' or 'raced'), np.inf without a limit
+        limits = []
+        for (limit, outcome) in ((max_total_steps, 'cut'), (race_limit, 'raced')):
+            if limit < np.inf:
+                step = max(1, int(limit - total_num_steps))
+                while step > 1 and total_num_steps + step - 1 > limit:
+                    step -= 1
+                while total_num_steps + step <= limit:
+                    step += 1
+                limits.append((step, outcome))
+        # the cutoff is checked before racing, so it wins a tie
+        return min(limits, default=(np.inf, None))
+    
+    def resolve_run(self, stop, total_num_steps, race_limit, max_total_steps, max_steps):
+        # (num_steps, outcome) expand_frontier gives a run that, with no cutoff or racing, stopped at stop -
+        # (steps, kind), or None for one still going past the limit
+        (limit_step, limit_outcome) = self.run_limit(total_num_steps, race_limit, max_total_steps)
+        if stop is None or stop[0] > limit_step:
+            return (limit_step, limit_outcome)
+        (stop_steps, kind) = stop
+        if kind == 'stuck':
+            return self.stuck_steps(stop_steps, total_num_steps, max_steps, max_total_steps)
+        return (stop_steps, kind)
+    
+    def stuck_steps(self, num_steps, total_num_steps, max_steps, max_total_steps):
+        # (num_steps, outcome) of a run with nothing left to reveal at num_steps - the revealed-array loop
+        # keeps picking closed cells until either the step limit or the early cutoff ends it
+        if max_total_steps < np.inf:
+            cut_steps = max(num_steps, int(max_total_steps - total_num_steps))
+            while total_num_steps + cut_steps <= max_total_steps:
+                cut_steps += 1
+            num_steps = min(cut_steps, max(num_steps, max_steps + 1))
+        else:
+            num_steps = max(num_steps, max_steps + 1)
+        if num_steps > max_steps:
+            print(num_steps)
+            return (num_steps, 'over')
+        return (num_steps, 'cut')
+    
+    def race_limit(self, num_runs_done):
+        # total steps allowed up to the end of the next racing rung - racing_slack times what the best program took
+        # a candidate past it can't pass the rung, so it is dropped right away
+        if self.best_run_totals is None:
+            return np.inf
+        rungs = [num_runs for num_runs in self.racing_checks if num_runs > num_runs_done]
+        if not rungs:
+            return np.inf
+        return self.racing_slack * self.best_run_totals[min(rungs) - 1]
+    
+    def count_expansions(self, pair_steps):
+        # runs over the step limit have run out of cells and are fast-forwarded, not expanded
+        num_expansions = sum(num_steps for (num_steps, outcome) in pair_steps if outcome != 'over')
+        self.num_expansions += num_expansions
+        self.stats.count('expansions', num_expansions)
+    
+    def max_total_steps(self):
+        # total steps over all pairs past which a run is cut short
+        if self.best_avg_steps_not_inf:
+            return self.best_avg_steps * self.num_pairs
+        return np.inf
+    
+    def score_pair_steps(self, pair_steps, update_best=True):
+        # turns per-pair steps into (avg_steps, add_to_plist, num_iters)
+        # the cutoff is re-applied with the current best, so steps run against
+        # an older (higher) best score the same as if they were run now
+        max_total_steps = self.max_total_steps()
+        
+        total_num_steps = 0
+        for i, (num_steps, outcome) in enumerate(pair_steps):
+            if self.rotate_maze:
+                costs_array_idx = i // 2
+            else:
+                costs_array_idx = i
+            
+            # last step checked against the cutoff
+            if outcome in ['cut', 'raced', 'screened']:
+                checked_steps = num_steps
+            else:
+                checked_steps = num_steps - 1
+            # a raced candidate is scored as if the cutoff had stopped it where racing did - the cutoff
+            # could only have stopped it there or later, so it never lands in a better bucket than a full run would
+            # a screened one as if its hopeless pair had used up the cutoff
+            if total_num_steps + checked_steps > max_total_steps or outcome in ['cut', 'raced', 'screened']:
+                return np.inf, True, costs_array_idx
+            if outcome == 'over':
+                return np.inf, None, None
+            
+            total_num_steps += num_steps
         
         avg_num_steps = total_num_steps / self.num_pairs
         if avg_num_steps < self.best_avg_steps and update_best:
             self.best_avg_steps_not_inf = True
             self.best_avg_steps = avg_num_steps
+            self.best_run_totals = np.cumsum([num_steps for (num_steps, _) in pair_steps]).tolist()
+        
+        return avg_num_steps, True, self.num_pairs
+    
+    def expand_frontier(self, costs, cell_cost, costs_shape, true_start, true_end, total_num_steps, race_limit=np.inf,
+                        resume=None):
+        # greedy expansion of one (start,goal) pair with a heap as the open list
+        # expands the same cells as repeatedly taking the minimum of a revealed array:
+        #   open cells hold their cost (<= 1), closed cells 7, walls and padding 9
+        # costs is the flat padded grid, read to tell walls apart, and cell_cost(idx) the cost a cell is opened with
+        # - the same list for grid evaluation, worked out on first use for lazy evaluation
+        # resume is (num_steps, seen, open_heap, closed) of a run taken that far elsewhere (run_pairs_batched)
+        true_msx = costs_shape[1]
+        start_idx = true_start[0] * true_msx + true_start[1]
+        end_idx = true_end[0] * true_msx + true_end[1]
+        max_steps = costs_shape[0] * costs_shape[1]
+        
+        max_total_steps = self.max_total_steps()
+        
+        neighbours = (-true_msx-1, -true_msx, -true_msx+1, -1, 1, true_msx-1, true_msx, true_msx+1)
+        random_tie_break = self.tie_break == 'random'
+        
+        # heap entries are (cost, key) - the key is the flat index, less depth * max_steps when ties go by g,
+        # so deeper cells come first and the index is still key % max_steps
+        g_step = -max_steps if self.tie_break == 'g' else 0
+        depth = [0] * max_steps if g_step else None
+        
+        if resume is None:
+            seen = bytearray(max_steps)
+            closed = np.zeros(max_steps, dtype=bool)
+            # the start is revealed with the closed value, so it is always expanded first
+            seen[start_idx] = 1
+            open_heap = [(7, start_idx)]
+            num_steps = 0
+        else:
+            (num_steps, seen, open_heap, closed) = resume
+        while True:
+            num_steps += 1
+            if not open_heap:
+                (num_steps, outcome) = self.stuck_steps(num_steps, total_num_steps, max_steps, max_total_steps)
+                return num_steps, outcome, closed.reshape(costs_shape)
+            
+            (cost, idx) = heapq.heappop(open_heap)
+            if g_step:
+                idx %= max_steps
+            elif random_tie_break and open_heap and open_heap[0][0] == cost:
+                # same draw as choosing among the sorted flat indices of every minimum
+                ties = [idx]
+                while open_heap and open_heap[0][0] == cost:
+                    ties.append(heapq.heappop(open_heap)[1])
+                idx = int(self.rng.choice(ties))
+                for tie_idx in ties:
+                    if tie_idx != idx:
+                        heapq.heappush(open_heap, (cost, tie_idx))
+            
+            if idx == end_idx:
+                break
+            closed[idx] = True
+            if g_step:
+                new_depth = depth[idx] + 1
+                for offset in neighbours:
+                    new_idx = idx + offset
+                    if not seen[new_idx] and costs[new_idx] < 7:
+                        seen[new_idx] = 1
+                        depth[new_idx] = new_depth
+                        heapq.heappush(open_heap, (cell_cost(new_idx), new_idx + new_depth * g_step))
+            else:
+                for offset in neighbours:
+                    new_idx = idx + offset
+                    if not seen[new_idx] and costs[new_idx] < 7:
+                        seen[new_idx] = 1
+                        heapq.heappush(open_heap, (cell_cost(new_idx), new_idx))
+            
+            if num_steps > max_steps:
+                print(num_steps)
+                return num_steps, 'over', closed.reshape(costs_shape)
+            if total_num_steps + num_steps > max_total_steps:
+                return num_steps, 'cut', closed.reshape(costs_shape)
+            if total_num_steps + num_steps > race_limit:
+                return num_steps, 'raced', closed.reshape(costs_shape)
         
-        return avg_num_steps, True, self.num_pairs
\ No newline at end of file
+        return num_steps, 'goal', closed.reshape(costs_shape)
@@ -0,0 +1,132 @@
+import time, json, heapq
+from tqdm import tqdm
+from search import prog_search
+from bank import program_bank
+from instrument import rss_bytes
+
+# best-first alternative to prog_search's size levels, for runs that have to fit a time and memory slot
+# work is a priority queue of (size1, size2) groups of the plist, keyed by (size1 + size2 + 1, best score in
+# either group) - the level the level search would combine them at, then how good their programs are.
+# the first bucket with rows past its watermark has its new combinations evaluated, and every group that
+# gains a program queues its buckets again - so there is no bound to pick, and no size resets, since a
+# program stored at a low mod_size is combined as soon as its level is the lowest with work left
+# it stops at the wall-clock deadline, past the RSS limit, or when there is no work left within bound
+
+class anytime_search(prog_search):
+    def __init__(self, grammar_constants, evaluator, deadline=None, max_rss_bytes=None, bound=None,
+                 improvements_location=None, stats=None, show_progress=True, result_store=None):
+        # bound is the highest level combined, None for no limit
+        super().__init__(bound, grammar_constants, evaluator, stats=stats, show_progress=show_progress,
+                         result_store=result_store)
+        # seconds from the start of the search, checked between evaluations
+        self.deadline = deadline
+        # resident set size to stay under, checked every rss_check_interval evaluations
+        self.max_rss_bytes = max_rss_bytes
+        self.rss_check_interval = 64
+        # each improvement is appended here as a json line as soon as it is found
+        self.improvements_location = improvements_location
+
+    def search(self):
+        # runs to a stop and returns the best program, None if nothing has finished every pair
+        for _ in self.improvements():
+            pass
+        return self.best_program
+
+    def improvements(self):
+        # the search as a generator of improvements - {'elapsed', 'program', 'avg_steps', 'heuristics_evaluated'}
+        # for each new best, so a caller can act on them while it runs
+        self.start_time = time.monotonic()
+        self.best_avg_steps = float('inf')
+        self.best_avg_steps_upon_last_reset = float('inf')
+        self.best_program = None
+        self.heuristics_evaluated = 0
+        self.improvement_log = []
+        self.stop_reason = None
+        self.bank = program_bank()
+        self.watermarks = {}
+        # (level, best score, (size1, size2)) of buckets that may have new combinations, each queued once
+        self.queue = []
+        self.queued = set()
+        progress_bar = tqdm(disable=not self.show_progress)
+
+        # the leaves are evaluated too, so there is a best as soon as one of them finishes every pair
+        for grammar_constant in self.grammar_constants:
+            idx = self.bank.add_node(grammar_constant)
+            if 1 in self.bank.groups and idx in self.bank.group(1):
+                continue
+            (avg_steps, _, _) = self.evaluate_program(grammar_constant)
+            self.bank.score[idx] = avg_steps
+            self.bank.group_append(1, idx)
+            self.heuristics_evaluated += 1
+            progress_bar.update()
+            if avg_steps < self.best_avg_steps:
+                print('\nNEW BEST FOUND:')
+                print(grammar_constant.toString())
+                print(avg_steps)
+                self.best_avg_steps = avg_steps
+                self.best_program = grammar_constant
+                yield self.report_improvement()
+        self.queue_buckets(1)
+
+        while self.queue:
+            (level, _, bucket) = heapq.heappop(self.queue)
+            self.queued.discard(bucket)
+            self.current_size = level
+            # programs stored while the bucket is combined are past these counts, and queue it again
+            group_counts = self.bank.group_counts()
+            self.valid_sizes_list = [bucket]
+            for new_program in self.generate_new_programs(group_counts):
+                self.stop_reason = self.budget_exceeded()
+                if self.stop_reason is not None:
+                    progress_bar.close()
+                    print(f'STOPPED ({self.stop_reason}) AFTER {self.heuristics_evaluated} PROGRAMS')
+                    return
+                self.stats.count('generated')
+                self.heuristics_evaluated += 1
+                progress_bar.update()
+                best_avg_steps = self.best_avg_steps
+                new_heuristic = self.build_heuristic(new_program)
+                avg_steps, add_to_plist, num_iters = self.evaluate_program(new_heuristic)
+                stored = self.add_result(new_program, new_heuristic, avg_steps, add_to_plist, num_iters)
+                if stored is not None:
+                    self.queue_buckets(stored[1])
+                if self.best_avg_steps < best_avg_steps:
+                    yield self.report_improvement()
+                self.stats.maybe_dump()
+
+        self.stop_reason = 'exhausted'
+        progress_bar.close()
+        print(f'STOPPED ({self.stop_reason}) AFTER {self.heuristics_evaluated} PROGRAMS')
+
+    def queue_buckets(self, mod_size):
+        # a group gained a program - queue its buckets with every group, within bound
+        for other_size in list(self.bank.groups):
+            bucket = tuple(sorted((mod_size, other_size)))
+            level = bucket[0] + bucket[1] + 1
+            if bucket in self.queued or (self.bound is not None and level > self.bound):
+                continue
+            best_score = min(self.bank.score[self.bank.group(size)].min() for size in bucket)
+            heapq.heappush(self.queue, (level, best_score, bucket))
+            self.queued.add(bucket)
+
+    def budget_exceeded(self):
+        # 'deadline' or 'memory' once a budget is used up, otherwise None
+        if self.deadline is not None and time.monotonic() - self.start_time >= self.deadline:
+            return 'deadline'
+        if (self.max_rss_bytes is not None and self.heuristics_evaluated % self.rss_check_interval == 0
+                and rss_bytes() > self.max_rss_bytes):
+            return 'memory'
+        return None
+
+    def report_improvement(self):
+        improvement = {
+            'elapsed': time.monotonic() - self.start_time,
+            'program': self.best_program.toString(),
+            'avg_steps': float(self.best_avg_steps),
+            'heuristics_evaluated': self.heuristics_evaluated,
+        }
+        self.improvement_log.append(improvement)
+        if self.improvements_location is not None:
+            with open(self.improvements_location, 'a') as f:
+                f.write(json.dumps(improvement) + '\n')
+        return improvement
@@ -0,0 +1,373 @@
+import os, json, time, argparse, contextlib
+import numpy as np
+from dsl import parse_program
+from a_star import a_star
+from search import prog_search
+from anytime import anytime_search
+from sweep import run_sweep, sweep_keys
+from heuristics import manhat_heur, manhat_diag_heur, map_heuristics
+from instrument import null_stats, run_stats, profiled
+from eval_cache import eval_cache
+from server import eval_server, eval_client
+
+# command line entry point - the settings of main.py as a config file or flags
+#   python -m astar_progsynth search --config sweep.toml --out results.json
+#   python -m astar_progsynth search --maps isound1 orz302d --bound 5 --set regularization_power=2
+#   python -m astar_progsynth eval --maps isound1 '(abs((state_x - goal_x)) + abs((state_y - goal_y)))'
+#   python -m astar_progsynth sweep --maps isound1 --bound 4 --grid regularization_power=1,1.5,2 --set tie_break='"index"'
+#   python -m astar_progsynth bench --num-pairs 10 --bound 3
+#   python -m astar_progsynth serve --maps isound1 --set server_location='"/tmp/isound1.sock"' --set tie_break='"index"'
+# several maps or runs go through one process, so loaded maps, their pairs and compiled kernels are reused
+# matplotlib is only imported with show_graphs, so runs are headless by default
+
+default_config = {
+    # A* hyperparameters
+    'map_name': 'isound1',
+    'map_dir': 'dao-map',
+    'num_pairs': 10,
+    'seed': None,
+    'tie_break': 'random',
+    # 'grid' or 'lazy' - costs over the whole map, or only at the cells A* opens
+    'evaluation': 'grid',
+    # 'heap' runs the pairs one after another, 'batched' advances many of them together (needs tie_break 'index')
+    'engine': 'heap',
+    # fractions of the pairs after which a candidate more than racing_slack times the best's steps on them is dropped
+    'racing_rungs': [],
+    'racing_slack': 1.5,
+    # rank correlation with the goal distances at or below which a pair is taken as hopeless (None - off)
+    'prescreen': None,
+    'pairs_location': None,
+    # GBUS hyperparameters
+    # 'levels' sweeps size levels up to bound, 'anytime' runs best first until a budget is used up
+    # (anytime.py - bound then limits the level combined, 0 for no limit)
+    'search_mode': 'levels',
+    'bound': 0,
+    'performance_type': 'zero',
+    'performance_log_base': 0.25,
+    'regularization_divisor': 10,
+    'regularization_power': 1.5,
+    'floor_individually': True,
+    'compare_normalized_costs': True,
+    # anytime budgets - seconds, and megabytes of resident memory (None for no limit), and a json lines
+    # file each improvement is appended to as it is found
+    'deadline': None,
+    'max_rss_mb': None,
+    'improvements_location': None,
+    # parallel evaluation - for serve, the worker pool of the server
+    'num_workers': 1,
+    'chunk_size': 16,
+    # sweep mode - lists of hyperparameter values to try, and a file keeping evaluated programs between sweeps
+    'sweep': {},
+    'store_location': None,
+    # evaluated programs kept in an sqlite file between sessions (needs tie_break 'index' or 'g')
+    'eval_cache_location': None,
+    'eval_cache_entries': 1000000,
+    # unix socket of an evaluation server (serve) - searches on the same map and pairs send it their programs
+    'server_location': None,
+    # programs a levels search keeps in flight at the server
+    'server_window': 64,
+    # checkpointing
+    'checkpoint_location': None,
+    'resume': False,
+    # instrumentation
+    'stats_location': None,
+    'stats_interval': 60,
+    'profiler': None,
+    'profile_location': None,
+    # TEST
+    'test_more_pairs': False,
+    # the map and the best program, and the manhattan, diagonal and per-map heuristic runs
+    'show_graphs': False,
+    'show_test_graphs': False,
+    'show_progress': True,
+    # grammar constants, in the toString() form of the dsl
+    'grammar': ['state_x', 'state_y', 'goal_x', 'goal_y', '0.5', '2'],
+}
+
+# settings that pick the loaded map and pairs - runs that agree on these share an evaluator
+evaluator_keys = ['map_name', 'map_dir', 'num_pairs', 'seed', 'tie_break', 'engine', 'evaluation', 'racing_rungs',
+                  'racing_slack', 'prescreen', 'pairs_location', 'eval_cache_location', 'eval_cache_entries']
+
+def read_config_file(config_location):
+    if config_location.endswith('.toml'):
+        import tomllib
+        with open(config_location, 'rb') as f:
+            return tomllib.load(f)
+    with open(config_location) as f:
+        return json.load(f)
+
+def expand_runs(file_config, overrides):
+    # a config file holds settings, plus optional 'maps' and 'runs' lists
+    # every run is defaults <- file settings <- the run's own settings <- command line overrides,
+    # repeated for each map when 'maps' is given
+    file_config = dict(file_config)
+    runs = file_config.pop('runs', None) or [{}]
+    file_maps = file_config.pop('maps', None)
+    maps = overrides.pop('maps', None) or file_maps
+    configs = []
+    for run in runs:
+        run_maps = run.get('maps', maps) or [None]
+        for map_name in run_maps:
+            config = dict(default_config)
+            config.update(file_config)
+            config.update({key: value for (key, value) in run.items() if key != 'maps'})
+            if map_name is not None:
+                config['map_name'] = map_name
+            config.update(overrides)
+            check_config(config)
+            configs.append(config)
+    return configs
+
+def check_config(config):
+    unknown = sorted(set(config) - set(default_config))
+    if unknown:
+        raise ValueError(f'unknown config settings: {", ".join(unknown)}')
+
+def parse_setting(text):
+    # key=value, where the value is read as json when it can be ('10', 'true', 'null', '[1, 2]')
+    if '=' not in text:
+        raise ValueError(f'expected key=value, got {text!r}')
+    (key, value) = text.split('=', 1)
+    return (key, parse_value(value))
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+class session:
+    def __init__(self):
+        # evaluators by their evaluator_keys settings, with the rng state right after their pairs were made
+        self.evaluators = {}
+
+    def evaluator(self, config):
+        key = tuple(json.dumps(config[name]) for name in evaluator_keys)
+        if key in self.evaluators:
+            (evaluator, rng_state) = self.evaluators[key]
+            # a fresh search on the same map and pairs, drawing the same random tie breaks as a new process would
+            evaluator.reset_search_state()
+            evaluator.rng.bit_generator.state = rng_state
+            return evaluator
+
+        cache = None
+        if config['eval_cache_location'] is not None:
+            cache = eval_cache(config['eval_cache_location'], max_entries=config['eval_cache_entries'])
+        evaluator = a_star(config['num_pairs'], tie_break=config['tie_break'], seed=config['seed'], engine=config['engine'],
+                           evaluation=config['evaluation'], eval_cache=cache,
+                           racing_rungs=config['racing_rungs'], racing_slack=config['racing_slack'],
+                           prescreen=config['prescreen'])
+        map_file_location = os.path.join(config['map_dir'], f"{config['map_name']}.map")
+        evaluator.load_map_from_file(map_file_location, show_graphs=config['show_graphs'])
+        pairs_location = config['pairs_location']
+        if pairs_location is not None and os.path.exists(pairs_location):
+            evaluator.load_pairs(pairs_location)
+        else:
+            evaluator.generate_start_goal_lists()
+            if pairs_location is not None:
+                evaluator.save_pairs(pairs_location)
+        evaluator.additional_gets()
+        self.evaluators[key] = (evaluator, evaluator.rng.bit_generator.state)
+        return evaluator
+
+def finite(value):
+    return float(value) if np.isfinite(value) else None
+
+def run_search(config, current_session=None):
+    current_session = current_session or session()
+    start_time = time.time()
+    evaluator = current_session.evaluator(config)
+    stats = run_stats(config['stats_location'], config['stats_interval']) if config['stats_location'] is not None else null_stats()
+    evaluator.stats = stats
+    result = {'map_name': config['map_name'], 'config': config}
+
+    # test if the maze and all (start,goal) pairs are connected - from the goal distance fields, before any A* run
+    disconnected_pairs = evaluator.disconnected_pairs()
+    if disconnected_pairs:
+        print('Broken maze!')
+        result['error'] = 'broken maze'
+        result['disconnected_pairs'] = disconnected_pairs
+        return result
+    optimal_avg_steps = evaluator.optimal_avg_steps()
+    print(f'OPTIMAL: {optimal_avg_steps}')
+    result['optimal'] = optimal_avg_steps
+
+    manhat_avg_steps, _, _ = evaluator.run_a_star(manhat_heur, update_best=False, show_graphs=config['show_test_graphs'])
+    print(f'MANHATTAN: {manhat_avg_steps}')
+    result['manhattan'] = finite(manhat_avg_steps)
+
+    manhat_diag_avg_steps, _, _ = evaluator.run_a_star(manhat_diag_heur, update_best=False, show_graphs=config['show_test_graphs'])
+    print(f'MANHATTAN DIAGONAL: {manhat_diag_avg_steps}')
+    result['manhattan_diagonal'] = finite(manhat_diag_avg_steps)
+
+    ### TEST PAIRS
+    if config['test_more_pairs'] and config['map_name'] in map_heuristics:
+        test_heuristic = map_heuristics[config['map_name']]
+        print(test_heuristic.toString())
+        test_heur_avg_steps, _, _ = evaluator.run_a_star(test_heuristic, update_best=False, show_graphs=config['show_test_graphs'])
+        print(f"Best heuristic synthesized for map '{config['map_name']}': {test_heur_avg_steps}")
+        result['map_heuristic'] = finite(test_heur_avg_steps)
+
+    # run bottom-up search
+    grammar_constants = [parse_program(text) for text in config['grammar']]
+    client = None
+    if config['server_location'] is not None:
+        client = eval_client(config['server_location'], evaluator, config['compare_normalized_costs'],
+                             window_size=config['server_window'])
+    if config['search_mode'] == 'anytime':
+        if config['num_workers'] > 1 or config['checkpoint_location'] is not None:
+            raise ValueError('the anytime search evaluates in this process and keeps no checkpoints')
+        max_rss_bytes = config['max_rss_mb'] * 2**20 if config['max_rss_mb'] is not None else None
+        synthesizer = anytime_search(grammar_constants, evaluator, deadline=config['deadline'], max_rss_bytes=max_rss_bytes,
+                                     bound=config['bound'] or None, improvements_location=config['improvements_location'],
+                                     show_progress=config['show_progress'], result_store=client)
+    elif config['search_mode'] == 'levels':
+        synthesizer = prog_search(config['bound'], grammar_constants, evaluator,
+                                  num_workers=config['num_workers'], chunk_size=config['chunk_size'],
+                                  checkpoint_location=config['checkpoint_location'],
+                                  show_progress=config['show_progress'], result_store=client)
+    else:
+        raise ValueError(f"unknown search_mode {config['search_mode']!r}, use 'levels' or 'anytime'")
+    synthesizer.initialize_hyperparameters(config['performance_type'], config['performance_log_base'],
+                                           config['regularization_divisor'], config['regularization_power'],
+                                           config['floor_individually'], config['compare_normalized_costs'])
+    profiler = config['profiler']
+    with profiled(profiler, config['profile_location']) if profiler is not None else contextlib.nullcontext():
+        if config['search_mode'] == 'anytime':
+            synthesizer.search()
+            result['stop_reason'] = synthesizer.stop_reason
+            result['improvements'] = synthesizer.improvement_log
+        else:
+            synthesizer.search(resume=config['resume'])
+    if client is not None:
+        client.close()
+
+    # evaulate best program
+    best_program = getattr(synthesizer, 'best_program', None)
+    result['best_program'] = best_program.toString() if best_program is not None else None
+    if best_program is not None:
+        best_avg_steps, _, _ = evaluator.run_a_star(best_program, update_best=False, show_graphs=config['show_graphs'])
+        print(f'BEST: {best_program.toString()} {best_avg_steps}')
+        result['best_avg_steps'] = finite(best_avg_steps)
+    else:
+        print('No program beat the cutoff')
+    result['heuristics_evaluated'] = synthesizer.heuristics_evaluated
+    result['wall_time'] = time.time() - start_time
+    if stats.enabled:
+        result['stats'] = stats.summary()
+    return result
+
+def run_sweep_config(config, current_session=None):
+    # every combination of config['sweep'] on one map and pair set, sharing evaluated programs
+    current_session = current_session or session()
+    evaluator = current_session.evaluator(config)
+    evaluator.stats = run_stats(config['stats_location'], config['stats_interval']) if config['stats_location'] is not None else null_stats()
+    grammar_constants = [parse_program(text) for text in config['grammar']]
+    base_hyperparameters = {key: config[key] for key in sweep_keys + ['compare_normalized_costs']}
+    (results, _) = run_sweep(config['bound'], grammar_constants, evaluator, base_hyperparameters, config['sweep'],
+                             store_location=config['store_location'], show_progress=config['show_progress'])
+    for result in results:
+        print(f"{result['hyperparameters']}: {result['best_program']} {result['best_avg_steps']}")
+    return [dict(result, map_name=config['map_name']) for result in results]
+
+def run_serve(config, current_session=None):
+    # evaluates the programs of searches started with the same server_location until interrupted
+    if config['server_location'] is None:
+        raise ValueError('serve needs a server_location for its socket')
+    current_session = current_session or session()
+    evaluator = current_session.evaluator(config)
+    evaluator.stats = run_stats(config['stats_location'], config['stats_interval']) if config['stats_location'] is not None else null_stats()
+    server = eval_server(evaluator, config['compare_normalized_costs'], config['server_location'],
+                         store_location=config['store_location'], num_workers=config['num_workers'],
+                         chunk_size=config['chunk_size'])
+    server.serve()
+    result = {'map_name': config['map_name'], 'requests': server.num_requests, 'clients': server.num_clients,
+              'coalesced': server.num_coalesced, 'store_hits': server.store.hits, 'evaluated': server.store.misses}
+    if evaluator.stats.enabled:
+        result['stats'] = evaluator.stats.summary()
+    return result
+
+def run_eval(config, programs, current_session=None):
+    # average steps of the given programs, or the manhattan, diagonal and per-map heuristics
+    current_session = current_session or session()
+    evaluator = current_session.evaluator(config)
+    if programs:
+        heuristics = {text: parse_program(text) for text in programs}
+    else:
+        heuristics = {'manhattan': manhat_heur, 'manhattan_diagonal': manhat_diag_heur}
+        if config['map_name'] in map_heuristics:
+            heuristics[config['map_name']] = map_heuristics[config['map_name']]
+    results = []
+    for (name, heuristic) in heuristics.items():
+        avg_steps, _, _ = evaluator.run_a_star(heuristic, update_best=False, show_graphs=config['show_graphs'])
+        print(f'{name}: {avg_steps}')
+        results.append({'map_name': config['map_name'], 'name': name, 'program': heuristic.toString(),
+                        'avg_steps': finite(avg_steps)})
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='astar_progsynth', description='synthesize A* heuristics')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in ['search', 'sweep', 'eval', 'serve']:
+        command_parser = commands.add_parser(command)
+        command_parser.add_argument('--config', default=None, help='json or toml file of settings')
+        command_parser.add_argument('--maps', nargs='+', default=None, help='run once for each map')
+        command_parser.add_argument('--num-pairs', type=int, default=None)
+        command_parser.add_argument('--seed', type=int, default=None)
+        command_parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                                    help='any config setting, e.g. --set regularization_power=2')
+        command_parser.add_argument('--show-graphs', action='store_true')
+        command_parser.add_argument('--out', default=None, help='json file of the results')
+        if command in ['search', 'sweep']:
+            command_parser.add_argument('--bound', type=int, default=None)
+        if command == 'sweep':
+            command_parser.add_argument('--grid', action='append', default=[], metavar='KEY=V1,V2,...',
+                                        help='values of one hyperparameter to sweep')
+        if command == 'eval':
+            command_parser.add_argument('programs', nargs='*', help='heuristics in their toString() form')
+    # everything after bench goes to bench.py unchanged
+    commands.add_parser('bench', add_help=False)
+    return parser.parse_known_args(argv)
+
+def main(argv=None):
+    (args, extra_args) = parse_args(argv)
+    if args.command == 'bench':
+        import bench
+        bench.main(extra_args)
+        return
+    if extra_args:
+        raise SystemExit(f'unrecognized arguments: {" ".join(extra_args)}')
+
+    overrides = dict(parse_setting(text) for text in args.set)
+    for name in ['maps', 'num_pairs', 'seed', 'bound']:
+        if getattr(args, name, None) is not None:
+            overrides[name] = getattr(args, name)
+    if args.show_graphs:
+        overrides['show_graphs'] = True
+    for text in getattr(args, 'grid', []):
+        (key, values) = text.split('=', 1)
+        overrides.setdefault('sweep', {})[key] = [parse_value(value) for value in values.split(',')]
+    file_config = read_config_file(args.config) if args.config is not None else {}
+    configs = expand_runs(file_config, overrides)
+
+    current_session = session()
+    results = []
+    if args.command == 'serve' and len(configs) > 1:
+        raise SystemExit('serve holds one map and pair set, give it a single map and run')
+    for config in configs:
+        print(f"=== {args.command} {config['map_name']} ===")
+        if args.command == 'search':
+            results.append(run_search(config, current_session))
+        elif args.command == 'sweep':
+            results += run_sweep_config(config, current_session)
+        elif args.command == 'serve':
+            results.append(run_serve(config, current_session))
+        else:
+            results += run_eval(config, args.programs, current_session)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import os, contextlib
+
+# files replaced whole - written to a temporary next to the target, flushed to disk, then renamed over it
+# a crash mid-write leaves the previous file intact, and concurrent readers never see half a file
+
+@contextlib.contextmanager
+def atomic_write(location, mode='wb'):
+    tmp_location = f'{location}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_location, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, location)
+    except BaseException:
+        # nothing half written is left behind
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_location)
+        raise
@@ -0,0 +1,135 @@
+import weakref
+import numpy as np
+from dsl import Plus, Minus, Times, Max, Min, Abs, Var, Num
+
+# opcodes - a binary operation, the absolute value of one, or a leaf
+# the enumeration only ever builds op(s1, s2) or abs(op(s1, s2)) from stored programs, so every one is a single row
+PLUS, MINUS, TIMES, MAX, MIN = range(5)
+ABS_PLUS, ABS_MINUS, ABS_TIMES, ABS_MAX, ABS_MIN = range(5, 10)
+ABS = 10
+LEAF = 11
+binary_classes = [Plus, Minus, Times, Max, Min]
+abs_offset = ABS_PLUS - PLUS
+
+# stored programs as integer rows in growing numpy columns, grouped by mod_size
+# left and right are row ids (for LEAF, left indexes leaves), so a program costs a few bytes instead of a tree of objects
+class program_bank:
+    def __init__(self, capacity=1024):
+        self.num_programs = 0
+        self.opcode = np.zeros(capacity, dtype=np.int8)
+        self.left = np.zeros(capacity, dtype=np.int32)
+        self.right = np.zeros(capacity, dtype=np.int32)
+        self.size = np.zeros(capacity, dtype=np.int32)
+        self.score = np.zeros(capacity, dtype=np.float64)
+        self.nonneg = np.zeros(capacity, dtype=bool)
+        self.const = np.zeros(capacity, dtype=bool)
+        self.leaves = []
+        # mod_size -> (ids buffer, count)
+        self.groups = {}
+        # nodes built from rows, kept only while something else holds them
+        self.nodes = weakref.WeakValueDictionary()
+        # strong references to the operand nodes of the bucket being combined, so they stay in nodes for its pass
+        self.held_nodes = {}
+        # rows added from whole trees, so add_node doesn't store a subtree twice
+        self.node_ids = {}
+
+    def columns(self):
+        return ['opcode', 'left', 'right', 'size', 'score', 'nonneg', 'const']
+
+    def add(self, node, opcode, left, right, score=np.inf):
+        # row id of a program built as (opcode, left, right) - flags and size are read off its node
+        if self.num_programs == len(self.opcode):
+            for name in self.columns():
+                column = getattr(self, name)
+                setattr(self, name, np.concatenate((column, np.zeros_like(column))))
+        idx = self.num_programs
+        self.opcode[idx] = opcode
+        self.left[idx] = left
+        self.right[idx] = right
+        self.size[idx] = node.getSize()
+        self.score[idx] = score
+        self.nonneg[idx] = node.isNonNegative()
+        self.const[idx] = node.isConstant()
+        self.num_programs += 1
+        self.nodes[idx] = node
+        return idx
+
+    def add_node(self, node, score=np.inf):
+        # row id of any tree, adding rows for its subtrees as needed
+        string = node.toString()
+        if string in self.node_ids:
+            return self.node_ids[string]
+        if isinstance(node, (Var, Num)):
+            self.leaves.append(node)
+            idx = self.add(node, LEAF, len(self.leaves) - 1, -1, score)
+        elif isinstance(node, Abs) and type(node.value) in binary_classes:
+            (left, right) = (self.add_node(node.value.left), self.add_node(node.value.right))
+            idx = self.add(node, binary_classes.index(type(node.value)) + abs_offset, left, right, score)
+        elif isinstance(node, Abs):
+            idx = self.add(node, ABS, self.add_node(node.value), -1, score)
+        else:
+            (left, right) = (self.add_node(node.left), self.add_node(node.right))
+            idx = self.add(node, binary_classes.index(type(node)), left, right, score)
+        self.node_ids[string] = idx
+        return idx
+
+    def group_append(self, mod_size, idx):
+        (ids, count) = self.groups.get(mod_size, (np.zeros(16, dtype=np.int32), 0))
+        if count == len(ids):
+            ids = np.concatenate((ids, np.zeros(max(len(ids), 16), dtype=np.int32)))
+        ids[count] = idx
+        self.groups[mod_size] = (ids, count + 1)
+
+    def group_counts(self):
+        # snapshot of every group - rows added later are past these counts
+        return {mod_size: count for (mod_size, (_, count)) in self.groups.items()}
+
+    def group(self, mod_size, count=None):
+        (ids, group_count) = self.groups[mod_size]
+        return ids[:group_count if count is None else count]
+
+    def compose(self, opcode, left_node, right_node=None):
+        # node of a row that isn't stored yet, from the nodes of its operands
+        if opcode == ABS:
+            return Abs(left_node)
+        if opcode >= abs_offset:
+            return Abs(binary_classes[opcode - abs_offset](left_node, right_node))
+        return binary_classes[opcode](left_node, right_node)
+
+    def node(self, idx):
+        # the tree of a row, rebuilt only when nobody holds it
+        node = self.nodes.get(idx)
+        if node is None:
+            opcode = int(self.opcode[idx])
+            if opcode == LEAF:
+                node = self.leaves[self.left[idx]]
+            elif opcode == ABS:
+                node = self.compose(opcode, self.node(int(self.left[idx])))
+            else:
+                node = self.compose(opcode, self.node(int(self.left[idx])), self.node(int(self.right[idx])))
+            self.nodes[idx] = node
+        return node
+
+    def hold(self, ids):
+        # keeps the nodes of these rows built until the next hold or release, dropping those held before
+        self.held_nodes = {idx: self.node(idx) for idx in ids}
+
+    def release(self):
+        self.held_nodes = {}
+
+    def state(self):
+        # arrays and leaves only - nodes are rebuilt on demand
+        state = {name: getattr(self, name)[:self.num_programs].copy() for name in self.columns()}
+        state['leaves'] = [(type(leaf).__name__, leaf.name if isinstance(leaf, Var) else leaf.value) for leaf in self.leaves]
+        state['groups'] = {mod_size: self.group(mod_size).copy() for mod_size in self.groups}
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        bank = cls(capacity=max(len(state['opcode']), 1))
+        bank.num_programs = len(state['opcode'])
+        for name in bank.columns():
+            getattr(bank, name)[:bank.num_programs] = state[name]
+        bank.leaves = [Var(value) if kind == 'Var' else Num(value) for (kind, value) in state['leaves']]
+        bank.groups = {mod_size: (ids.copy(), len(ids)) for (mod_size, ids) in state['groups'].items()}
+        return bank
@@ -0,0 +1,147 @@
+import os, sys, io, json, time, platform, argparse, contextlib, resource
+import numpy as np
+from a_star import a_star
+from search import prog_search
+from heuristics import manhat_heur, manhat_diag_heur, map_heuristics
+from main import grammar_constants
+
+# throughput benchmarks of the evaluator and the search, written as json so runs can be compared
+# python bench.py --maps isound1 orz302d --num-pairs 10 50 --bound 3 --out bench.json
+
+def reset_peak_rss():
+    # linux lets the peak resident set size be reset, so each benchmark gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak of the whole process - kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def build_evaluator(map_name, num_pairs, args):
+    # a map from dao-map, or a synthetic maze of args.synthetic_size when the file is absent
+    evaluator = a_star(num_pairs, tie_break=args.tie_break, seed=args.seed, engine=args.engine, evaluation=args.evaluation)
+    map_file_location = os.path.join(args.map_dir, f'{map_name}.map')
+    with contextlib.redirect_stdout(io.StringIO()):
+        if os.path.exists(map_file_location):
+            evaluator.load_map_from_file(map_file_location)
+            source = map_file_location
+        else:
+            evaluator.generate_maze((args.synthetic_size, args.synthetic_size), args.synthetic_cutoff)
+            source = f'synthetic {args.synthetic_size}x{args.synthetic_size} cutoff {args.synthetic_cutoff}'
+        evaluator.generate_start_goal_lists()
+    evaluator.additional_gets()
+    return (evaluator, source)
+
+def bench_heuristics(map_name, num_pairs, args):
+    (evaluator, source) = build_evaluator(map_name, num_pairs, args)
+    heuristics = {'manhattan': manhat_heur, 'manhattan_diagonal': manhat_diag_heur}
+    if map_name in map_heuristics:
+        heuristics[map_name] = map_heuristics[map_name]
+
+    results = []
+    for (name, heuristic) in heuristics.items():
+        reset_peak_rss()
+        evaluator.num_expansions = 0
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                (avg_steps, _, _) = evaluator.run_a_star(heuristic, compare_normalized_costs=True, update_best=False)
+        wall_time = time.perf_counter() - start_time
+        results.append({
+            'map': map_name,
+            'source': source,
+            'num_pairs': num_pairs,
+            'heuristic': name,
+            'program': heuristic.toString(),
+            'avg_steps': avg_steps if np.isfinite(avg_steps) else None,
+            'repeat': args.repeat,
+            'expansions': evaluator.num_expansions,
+            'wall_time': wall_time,
+            'expansions_per_sec': evaluator.num_expansions / wall_time,
+            'heuristics_per_sec': args.repeat / wall_time,
+            'peak_rss_bytes': peak_rss_bytes(),
+        })
+    return results
+
+def bench_search(map_name, num_pairs, args):
+    (evaluator, source) = build_evaluator(map_name, num_pairs, args)
+    synthesizer = prog_search(args.bound, grammar_constants, evaluator)
+    synthesizer.initialize_hyperparameters('zero', 0.25, 10, 1.5, True, True)
+
+    reset_peak_rss()
+    start_time = time.perf_counter()
+    # the search reports to stdout and tqdm to stderr - both stay out of the json
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        synthesizer.search()
+    wall_time = time.perf_counter() - start_time
+    best_program = getattr(synthesizer, 'best_program', None)
+    return {
+        'map': map_name,
+        'source': source,
+        'num_pairs': num_pairs,
+        'bound': args.bound,
+        'best_program': best_program.toString() if best_program is not None else None,
+        'best_avg_steps': synthesizer.best_avg_steps if np.isfinite(synthesizer.best_avg_steps) else None,
+        'heuristics_evaluated': synthesizer.heuristics_evaluated,
+        'expansions': evaluator.num_expansions,
+        'wall_time': wall_time,
+        'expansions_per_sec': evaluator.num_expansions / wall_time,
+        'heuristics_per_sec': synthesizer.heuristics_evaluated / wall_time,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='evaluator and search throughput')
+    parser.add_argument('--maps', nargs='+', default=['isound1', 'orz302d', 'brc501d'])
+    parser.add_argument('--map-dir', default='dao-map')
+    parser.add_argument('--num-pairs', nargs='+', type=int, default=[10, 50])
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each fixed heuristic')
+    parser.add_argument('--bound', type=int, default=3, help='search bound, 0 skips the search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tie-break', default='index', choices=['random', 'index', 'g'])
+    parser.add_argument('--engine', default='heap', choices=['heap', 'batched'])
+    parser.add_argument('--evaluation', default='grid', choices=['grid', 'lazy'])
+    parser.add_argument('--synthetic-size', type=int, default=256)
+    parser.add_argument('--synthetic-cutoff', type=float, default=0.9)
+    parser.add_argument('--out', default=None, help='json file, stdout if not given')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'heuristics': [],
+        'search': [],
+    }
+    for map_name in args.maps:
+        for num_pairs in args.num_pairs:
+            results['heuristics'] += bench_heuristics(map_name, num_pairs, args)
+    if args.bound > 0:
+        results['search'].append(bench_search(args.maps[0], args.num_pairs[0], args))
+
+    if args.out is None:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
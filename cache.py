@@ -0,0 +1,46 @@
+from collections import OrderedDict
+import numpy as np
+
+# least recently used store of program values, keyed by program string
+# values are the stacked (num_pairs, msy, msx) costs of a program (or anything that broadcasts to it)
+class value_cache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.values:
+            self.values.move_to_end(key)
+            return
+        value_bytes = np.asarray(value).nbytes
+        if value_bytes > self.max_bytes:
+            return
+        self.values[key] = value
+        self.num_bytes += value_bytes
+        # evict least recently used values until back under budget
+        while self.num_bytes > self.max_bytes:
+            (_, old_value) = self.values.popitem(last=False)
+            self.num_bytes -= np.asarray(old_value).nbytes
+
+    # value of a subprogram - cached if available, otherwise interpreted
+    def lookup(self, node, env):
+        value = self.get(node.toString())
+        if value is None:
+            value = node.interpret_cached(env, self)
+        return value
+
+    def clear(self):
+        self.values.clear()
+        self.num_bytes = 0
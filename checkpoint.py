@@ -0,0 +1,64 @@
+import pickle
+from dsl import Plus, Minus, Times, Max, Min, Abs, Var, Num
+from atomic import atomic_write
+
+# bump when the checkpoint layout changes
+checkpoint_version = 5
+
+binary_ops = {Plus: '+', Minus: '-', Times: '*', Max: 'max', Min: 'min'}
+binary_classes = {op: cls for (cls, op) in binary_ops.items()}
+
+def encode_programs(programs):
+    # (node table, index of each program) - shared subtrees are stored once
+    # each row refers to earlier rows: ('+', left, right), ('abs', value), ('var', name), ('num', value)
+    table = []
+    node_idx = {}
+
+    def encode(node):
+        key = id(node)
+        if key in node_idx:
+            return node_idx[key]
+        if type(node) in binary_ops:
+            row = (binary_ops[type(node)], encode(node.left), encode(node.right))
+        elif isinstance(node, Abs):
+            row = ('abs', encode(node.value))
+        elif isinstance(node, Var):
+            row = ('var', node.name)
+        elif isinstance(node, Num):
+            row = ('num', node.value)
+        else:
+            raise TypeError(f'cannot encode {type(node).__name__}')
+        table.append(row)
+        node_idx[key] = len(table) - 1
+        return node_idx[key]
+
+    return (table, [encode(program) for program in programs])
+
+def decode_programs(table):
+    # nodes of a table from encode_programs, in the same order
+    nodes = []
+    for row in table:
+        op = row[0]
+        if op in binary_classes:
+            nodes.append(binary_classes[op](nodes[row[1]], nodes[row[2]]))
+        elif op == 'abs':
+            nodes.append(Abs(nodes[row[1]]))
+        elif op == 'var':
+            nodes.append(Var(row[1]))
+        elif op == 'num':
+            nodes.append(Num(row[1]))
+        else:
+            raise ValueError(f'unknown op {op!r} in checkpoint')
+    return nodes
+
+def save_checkpoint(checkpoint_location, state):
+    # written to a temporary file first, so a crash mid-write leaves the previous checkpoint intact
+    with atomic_write(checkpoint_location) as f:
+        pickle.dump(dict(state, version=checkpoint_version), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_checkpoint(checkpoint_location):
+    with open(checkpoint_location, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('version') != checkpoint_version:
+        raise ValueError(f'{checkpoint_location}: checkpoint version {state.get("version")}, expected {checkpoint_version}')
+    return state
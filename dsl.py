@@ -1,3 +1,5 @@
+import re, weakref
+from collections import OrderedDict
 import numpy as np
 
 '''
@@ -17,11 +19,48 @@ DSL:
     2
 '''
 
+# every live program by its string, so building one that already exists returns the existing node
+# identical subtrees are shared, and nodes can be compared by identity
+interned_nodes = weakref.WeakValueDictionary()
+
 # parent class of nodes on the tree (parts of the CFG)
+# nodes are immutable - the string and size are computed once, when the node is built
 class Node:
+    __slots__ = ('string', 'size', '__weakref__')
+    
+    def __new__(cls, *args):
+        string = cls.makeString(*args)
+        node = interned_nodes.get(string)
+        if node is None:
+            node = object.__new__(cls)
+            node.string = string
+            node.build(*args)
+            interned_nodes[string] = node
+        return node
+    
+    # canonical string of a node built from args
+    @staticmethod
+    def makeString(*args):
+        raise Exception('Unimplemented method')
+    
+    # sets the fields of a new node, other than its string
+    def build(self, *args):
+        raise Exception('Unimplemented method')
+    
+    # rebuilt through __new__ when unpickled, so copies in worker processes are interned too
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in type(self).__slots__))
+    
+    # shared, never copied
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+    
     # converts program to a string
     def toString(self):
-        raise Exception('Unimplemented method')
+        return self.string
     
     # interprets the output of a program
     # env is a dict of variable values
@@ -30,121 +69,435 @@ class Node:
     
     # computes the size of a program
     def getSize(self):
+        return self.size
+    
+    # interprets a program, taking subprogram values from a value_cache when present
+    def interpret_cached(self, env, cache):
+        return self.interpret(env)
+    
+    # whether the program can never be negative (coordinates are never negative)
+    def isNonNegative(self):
+        raise Exception('Unimplemented method')
+    
+    # whether the program doesn't depend on state_x or state_y
+    def isConstant(self):
+        raise Exception('Unimplemented method')
+    
+    # (lowest, highest) value of a program, given (lowest, highest) of each variable
+    def getRange(self, bounds):
         raise Exception('Unimplemented method')
 
 # addition
 class Plus(Node):
-    def __init__(self, left, right):
+    __slots__ = ('left', 'right')
+    ufunc = 'np.add'
+    
+    @staticmethod
+    def makeString(left, right):
+        return "(" + left.string + " + " + right.string + ")"
+    
+    def build(self, left, right):
         self.left = left
         self.right = right
-
-    def toString(self):
-        return "(" + self.left.toString() + " + " + self.right.toString() + ")"
+        self.size = left.size + right.size + 1
 
     def interpret(self, env):
-        return self.left.interpret(env) + self.right.interpret(env)
+        return self.apply(self.left.interpret(env), self.right.interpret(env))
     
-    def getSize(self):
-        return self.left.getSize() + self.right.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return self.apply(cache.lookup(self.left, env), cache.lookup(self.right, env))
+    
+    def apply(self, left, right):
+        return left + right
+    
+    def isNonNegative(self):
+        return self.left.isNonNegative() and self.right.isNonNegative()
+    
+    def isConstant(self):
+        return self.left.isConstant() and self.right.isConstant()
+    
+    def getRange(self, bounds):
+        (left_lo, left_hi) = self.left.getRange(bounds)
+        (right_lo, right_hi) = self.right.getRange(bounds)
+        return (left_lo + right_lo, left_hi + right_hi)
 
 # subtraction
 class Minus(Node):
-    def __init__(self, left, right):
+    __slots__ = ('left', 'right')
+    ufunc = 'np.subtract'
+    
+    @staticmethod
+    def makeString(left, right):
+        return "(" + left.string + " - " + right.string + ")"
+    
+    def build(self, left, right):
         self.left = left
         self.right = right
-
-    def toString(self):
-        return "(" + self.left.toString() + " - " + self.right.toString() + ")"
+        self.size = left.size + right.size + 1
 
     def interpret(self, env):
-        return self.left.interpret(env) - self.right.interpret(env)
+        return self.apply(self.left.interpret(env), self.right.interpret(env))
     
-    def getSize(self):
-        return self.left.getSize() + self.right.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return self.apply(cache.lookup(self.left, env), cache.lookup(self.right, env))
+    
+    def apply(self, left, right):
+        return left - right
+    
+    def isNonNegative(self):
+        return False
+    
+    def isConstant(self):
+        return self.left.isConstant() and self.right.isConstant()
+    
+    def getRange(self, bounds):
+        (left_lo, left_hi) = self.left.getRange(bounds)
+        (right_lo, right_hi) = self.right.getRange(bounds)
+        return (left_lo - right_hi, left_hi - right_lo)
 
 # multiplication
 class Times(Node):
-    def __init__(self, left, right):
+    __slots__ = ('left', 'right')
+    ufunc = 'np.multiply'
+    
+    @staticmethod
+    def makeString(left, right):
+        return "(" + left.string + " * " + right.string + ")"
+    
+    def build(self, left, right):
         self.left = left
         self.right = right
-
-    def toString(self):
-        return "(" + self.left.toString() + " * " + self.right.toString() + ")"
+        self.size = left.size + right.size + 1
 
     def interpret(self, env):
-        return self.left.interpret(env) * self.right.interpret(env)
+        return self.apply(self.left.interpret(env), self.right.interpret(env))
     
-    def getSize(self):
-        return self.left.getSize() + self.right.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return self.apply(cache.lookup(self.left, env), cache.lookup(self.right, env))
+    
+    def apply(self, left, right):
+        return left * right
+    
+    def isNonNegative(self):
+        return self.left.isNonNegative() and self.right.isNonNegative()
+    
+    def isConstant(self):
+        return self.left.isConstant() and self.right.isConstant()
+    
+    def getRange(self, bounds):
+        (left_lo, left_hi) = self.left.getRange(bounds)
+        (right_lo, right_hi) = self.right.getRange(bounds)
+        products = [left_lo * right_lo, left_lo * right_hi, left_hi * right_lo, left_hi * right_hi]
+        return (min(products), max(products))
 
 # maximum
 class Max(Node):
-    def __init__(self, left, right):
+    __slots__ = ('left', 'right')
+    ufunc = 'np.maximum'
+    
+    @staticmethod
+    def makeString(left, right):
+        return "max(" + left.string + ", " + right.string + ")"
+    
+    def build(self, left, right):
         self.left = left
         self.right = right
-
-    def toString(self):
-        return "max(" + self.left.toString() + ", " + self.right.toString() + ")"
+        self.size = left.size + right.size + 1
 
     def interpret(self, env):
-        return np.maximum(self.left.interpret(env), self.right.interpret(env))
+        return self.apply(self.left.interpret(env), self.right.interpret(env))
     
-    def getSize(self):
-        return self.left.getSize() + self.right.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return self.apply(cache.lookup(self.left, env), cache.lookup(self.right, env))
+    
+    def apply(self, left, right):
+        return np.maximum(left, right)
+    
+    def isNonNegative(self):
+        return self.left.isNonNegative() or self.right.isNonNegative()
+    
+    def isConstant(self):
+        return self.left.isConstant() and self.right.isConstant()
+    
+    def getRange(self, bounds):
+        (left_lo, left_hi) = self.left.getRange(bounds)
+        (right_lo, right_hi) = self.right.getRange(bounds)
+        return (max(left_lo, right_lo), max(left_hi, right_hi))
 
 # variable
 class Min(Node):
-    def __init__(self, left, right):
+    __slots__ = ('left', 'right')
+    ufunc = 'np.minimum'
+    
+    @staticmethod
+    def makeString(left, right):
+        return "min(" + left.string + ", " + right.string + ")"
+    
+    def build(self, left, right):
         self.left = left
         self.right = right
-
-    def toString(self):
-        return "min(" + self.left.toString() + ", " + self.right.toString() + ")"
+        self.size = left.size + right.size + 1
 
     def interpret(self, env):
-        return np.minimum(self.left.interpret(env), self.right.interpret(env))
+        return self.apply(self.left.interpret(env), self.right.interpret(env))
     
-    def getSize(self):
-        return self.left.getSize() + self.right.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return self.apply(cache.lookup(self.left, env), cache.lookup(self.right, env))
+    
+    def apply(self, left, right):
+        return np.minimum(left, right)
+    
+    def isNonNegative(self):
+        return self.left.isNonNegative() and self.right.isNonNegative()
+    
+    def isConstant(self):
+        return self.left.isConstant() and self.right.isConstant()
+    
+    def getRange(self, bounds):
+        (left_lo, left_hi) = self.left.getRange(bounds)
+        (right_lo, right_hi) = self.right.getRange(bounds)
+        return (min(left_lo, right_lo), min(left_hi, right_hi))
 
 # absolute value
 class Abs(Node):
-    def __init__(self, value):
+    __slots__ = ('value',)
+    ufunc = 'np.absolute'
+    
+    @staticmethod
+    def makeString(value):
+        return "abs(" + value.string + ")"
+    
+    def build(self, value):
         self.value = value
-
-    def toString(self):
-        return "abs(" + self.value.toString() + ")"
+        self.size = value.size + 1
 
     def interpret(self, env):
         return np.abs(self.value.interpret(env))
     
-    def getSize(self):
-        return self.value.getSize() + 1
+    def interpret_cached(self, env, cache):
+        return np.abs(cache.lookup(self.value, env))
+    
+    def isNonNegative(self):
+        return True
+    
+    def isConstant(self):
+        return self.value.isConstant()
+    
+    def getRange(self, bounds):
+        (lo, hi) = self.value.getRange(bounds)
+        if lo >= 0:
+            return (lo, hi)
+        if hi <= 0:
+            return (-hi, -lo)
+        return (0, max(-lo, hi))
 
 # variable
 class Var(Node):
-    def __init__(self, name):
+    __slots__ = ('name',)
+    
+    @staticmethod
+    def makeString(name):
+        return name
+    
+    def build(self, name):
         self.name = name
-
-    def toString(self):
-        return self.name
+        self.size = 1
 
     def interpret(self, env):
         return env[self.name]
     
-    def getSize(self):
-        return 1
+    def isNonNegative(self):
+        return True
+    
+    def isConstant(self):
+        return self.name not in ['state_x', 'state_y']
+    
+    def getRange(self, bounds):
+        return bounds[self.name]
 
 # number
 class Num(Node):
-    def __init__(self, value):
+    __slots__ = ('value',)
+    
+    @staticmethod
+    def makeString(value):
+        return str(value)
+    
+    def build(self, value):
         self.value = value
-
-    def toString(self):
-        return str(self.value)
+        self.size = 1
 
     def interpret(self, env):
         return self.value
     
-    def getSize(self):
-        return 1
\ No newline at end of file
+    def isNonNegative(self):
+        return self.value >= 0
+    
+    def isConstant(self):
+        return True
+    
+    def getRange(self, bounds):
+        return (self.value, self.value)
+
+# shape of each variable in the stacked environment: (varies over pairs, varies over the grid)
+var_kinds = {
+    'state_x': (False, True),
+    'state_y': (False, True),
+    'goal_x':  (True, False),
+    'goal_y':  (True, False),
+}
+
+# turns a program into one generated numpy function
+# temporaries are reused through out= whenever shape and dtype allow it
+class kernel_compiler:
+    def __init__(self):
+        self.lines = []
+        self.var_names = []
+        self.num_temps = 0
+        self.free_temps = []
+
+    # returns (code, kind, is_float, is_temp) for the value of node
+    def emit(self, node):
+        if isinstance(node, Var):
+            if node.name not in self.var_names:
+                self.var_names.append(node.name)
+            return node.name, var_kinds.get(node.name), False, False
+        
+        if isinstance(node, Num):
+            return repr(node.value), (False, False), isinstance(node.value, float), False
+        
+        if isinstance(node, Abs):
+            children = [self.emit(node.value)]
+        else:
+            children = [self.emit(node.left), self.emit(node.right)]
+        
+        kinds = [child[1] for child in children]
+        if None in kinds:
+            kind = None
+        else:
+            kind = (any(k[0] for k in kinds), any(k[1] for k in kinds))
+        is_float = any(child[2] for child in children)
+        
+        # fold constant subtrees
+        if kind == (False, False):
+            value = node.interpret({})
+            return repr(value.item() if hasattr(value, 'item') else value), kind, is_float, False
+        
+        # write into a temporary of the same shape and dtype if there is one
+        out = None
+        if kind is not None:
+            for child in children:
+                if child[3] and child[1] == kind and child[2] == is_float and out is None:
+                    out = child[0]
+            for i, free_temp in enumerate(self.free_temps):
+                if out is None and free_temp[1] == kind and free_temp[2] == is_float:
+                    out = self.free_temps.pop(i)[0]
+        
+        args = ', '.join(child[0] for child in children)
+        if out is None:
+            out = f't{self.num_temps}'
+            self.num_temps += 1
+            self.lines.append(f'{out} = {node.ufunc}({args})')
+        else:
+            self.lines.append(f'{node.ufunc}({args}, out={out})')
+        
+        # temporaries of the children are free to reuse once they've been read
+        for child in children:
+            if child[3] and child[0] != out:
+                self.free_temps.append((child[0], child[1], child[2]))
+        
+        return out, kind, is_float, True
+
+    def compile(self, node):
+        (result, _, _, _) = self.emit(node)
+        source = ['def kernel(env):']
+        source += [f'    {name} = env[{name!r}]' for name in self.var_names]
+        source += [f'    {line}' for line in self.lines]
+        source += [f'    return {result}']
+        namespace = {'np': np}
+        exec('\n'.join(source), namespace)
+        return namespace['kernel']
+
+# compiled kernels, least recently used dropped first
+compiled_kernels = OrderedDict()
+max_compiled_kernels = 65536
+
+def compile_program(node):
+    key = node.toString()
+    kernel = compiled_kernels.get(key)
+    if kernel is None:
+        kernel = kernel_compiler().compile(node)
+        compiled_kernels[key] = kernel
+        if len(compiled_kernels) > max_compiled_kernels:
+            compiled_kernels.popitem(last=False)
+    else:
+        compiled_kernels.move_to_end(key)
+    return kernel
+
+# scalar form of a program, f(state_x, state_y, goal_x, goal_y) for one cell - toString() is already python
+# for the few cells a search touches this beats a numpy kernel over the whole grid
+compiled_scalars = OrderedDict()
+
+def compile_scalar(node):
+    key = node.toString()
+    function = compiled_scalars.get(key)
+    if function is None:
+        function = eval(f'lambda state_x, state_y, goal_x, goal_y: {key}', {'max': max, 'min': min, 'abs': abs})
+        compiled_scalars[key] = function
+        if len(compiled_scalars) > max_compiled_kernels:
+            compiled_scalars.popitem(last=False)
+    else:
+        compiled_scalars.move_to_end(key)
+    return function
+
+# reads a program back from its toString() form, e.g. 'max(abs((state_x - goal_x)), 0.5)'
+number_pattern = re.compile(r'-?\d+(\.\d*)?([eE][-+]?\d+)?')
+name_pattern = re.compile(r'[A-Za-z_]\w*')
+infix_classes = {'+': Plus, '-': Minus, '*': Times}
+call_classes = {'max': Max, 'min': Min}
+
+def parse_program(text):
+    (node, pos) = parse_node(text, 0)
+    if text[pos:].strip():
+        raise ValueError(f'unexpected {text[pos:]!r} after program')
+    return node
+
+def parse_node(text, pos):
+    pos = skip_spaces(text, pos)
+    if text.startswith('(', pos):
+        (left, pos) = parse_node(text, pos + 1)
+        pos = skip_spaces(text, pos)
+        op = text[pos:pos+1]
+        if op not in infix_classes:
+            raise ValueError(f'expected +, - or * at {pos} in {text!r}')
+        (right, pos) = parse_node(text, pos + 1)
+        return (infix_classes[op](left, right), expect(text, pos, ')'))
+    name_match = name_pattern.match(text, pos)
+    if name_match is not None:
+        name = name_match.group()
+        pos = name_match.end()
+        if name in call_classes:
+            (left, pos) = parse_node(text, expect(text, pos, '('))
+            (right, pos) = parse_node(text, expect(text, pos, ','))
+            return (call_classes[name](left, right), expect(text, pos, ')'))
+        if name == 'abs':
+            (value, pos) = parse_node(text, expect(text, pos, '('))
+            return (Abs(value), expect(text, pos, ')'))
+        return (Var(name), pos)
+    number_match = number_pattern.match(text, pos)
+    if number_match is not None:
+        number = number_match.group()
+        value = int(number) if number_match.group(1) is None and number_match.group(2) is None else float(number)
+        return (Num(value), number_match.end())
+    raise ValueError(f'expected a program at {pos} in {text!r}')
+
+def skip_spaces(text, pos):
+    while pos < len(text) and text[pos] == ' ':
+        pos += 1
+    return pos
+
+def expect(text, pos, char):
+    pos = skip_spaces(text, pos)
+    if not text.startswith(char, pos):
+        raise ValueError(f'expected {char!r} at {pos} in {text!r}')
+    return pos + 1
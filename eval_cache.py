@@ -0,0 +1,156 @@
+import os, pickle, sqlite3
+import numpy as np
+from dsl import Plus, Minus, Times, Max, Min, Abs
+
+# evaluated programs kept on disk between sessions and size resets, in sqlite
+# rows are keyed by (map hash, pairs and settings hash, canonical program) and hold the
+# evaluate_pairs result - (costs_key, pair_steps), or None for a rejected program - with the step cutoff it ran under
+# WAL mode lets worker processes read while one of them writes, and busy writers wait rather than fail
+# least recently used rows past max_entries are evicted every evict_interval inserts, and on close
+
+# bump when the row layout changes
+cache_version = 1
+
+commutative_ops = {Plus: '+', Times: '*', Max: 'max', Min: 'min'}
+
+def canonical_string(node):
+    # toString with the operands of commutative operations in sorted order, so a + b and b + a share a row
+    # exact in floating point as well - a + b == b + a, a * b == b * a, max and min pick the same value
+    if type(node) in commutative_ops:
+        (left, right) = sorted((canonical_string(node.left), canonical_string(node.right)))
+        if isinstance(node, (Max, Min)):
+            return f'{commutative_ops[type(node)]}({left}, {right})'
+        return f'({left} {commutative_ops[type(node)]} {right})'
+    if isinstance(node, Minus):
+        return f'({canonical_string(node.left)} - {canonical_string(node.right)})'
+    if isinstance(node, Abs):
+        return f'abs({canonical_string(node.value)})'
+    return node.toString()
+
+class eval_cache:
+    def __init__(self, cache_location, max_entries=1000000, evict_interval=1000):
+        self.cache_location = cache_location
+        self.max_entries = max_entries
+        # inserts between eviction passes
+        self.evict_interval = evict_interval
+        self.num_inserts = 0
+        # hits are written back as a batch, so reads don't each take the write lock
+        self.pending_hits = {}
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.connection_pid = None
+
+    def __getstate__(self):
+        # sqlite connections can't cross processes - workers open their own
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['connection_pid'] = None
+        state['pending_hits'] = {}
+        return state
+
+    def connect(self):
+        # opened on first use in each process, including forked workers that inherited a parent's connection
+        if self.connection is not None and self.connection_pid == os.getpid():
+            return self.connection
+        self.connection = sqlite3.connect(self.cache_location, timeout=60, isolation_level=None)
+        self.connection_pid = os.getpid()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        self.connection.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('version', cache_version))
+        (version,) = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('version',)).fetchone()
+        if version != cache_version:
+            raise ValueError(f'{self.cache_location}: cache version {version}, expected {cache_version}')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                'map_hash BLOB, setup_hash BLOB, program TEXT, '
+                                'result BLOB, cutoff REAL, last_used INTEGER, '
+                                'PRIMARY KEY (map_hash, setup_hash, program))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        return self.connection
+
+    def use_counter(self, connection):
+        # shared across processes so recency is comparable between them
+        connection.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('uses', 0))
+        connection.execute('UPDATE meta SET value = value + 1 WHERE key = ?', ('uses',))
+        (uses,) = connection.execute('SELECT value FROM meta WHERE key = ?', ('uses',)).fetchone()
+        return uses
+
+    def get(self, map_hash, setup_hash, program, max_total_steps):
+        # (found, result) - found when the stored result holds for runs cut at max_total_steps
+        row = self.connect().execute('SELECT result, cutoff FROM results WHERE map_hash = ? AND setup_hash = ? AND program = ?',
+                                     (map_hash, setup_hash, program)).fetchone()
+        # a run cut short under a lower cutoff doesn't say what happens past it
+        if row is None or max_total_steps > row[1]:
+            self.misses += 1
+            return (False, None)
+        self.hits += 1
+        self.pending_hits[(map_hash, setup_hash, program)] = True
+        if len(self.pending_hits) >= self.evict_interval:
+            self.flush()
+        return (True, pickle.loads(row[0]))
+
+    def put(self, map_hash, setup_hash, program, result, max_total_steps):
+        # results that weren't cut (or screened, which only happens under a cutoff) hold for every cutoff
+        if result is not None and result[1][-1][1] in ['cut', 'screened']:
+            cutoff = float(max_total_steps)
+        else:
+            cutoff = np.inf
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            uses = self.use_counter(connection)
+            # another process may have stored the same program meanwhile - keep whichever holds for more cutoffs
+            connection.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?) '
+                               'ON CONFLICT (map_hash, setup_hash, program) DO UPDATE SET '
+                               'result = excluded.result, cutoff = excluded.cutoff, last_used = excluded.last_used '
+                               'WHERE excluded.cutoff > results.cutoff',
+                               (map_hash, setup_hash, program, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL),
+                                cutoff, uses))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.num_inserts += 1
+        if self.num_inserts % self.evict_interval == 0:
+            self.flush()
+            self.evict()
+
+    def flush(self):
+        # record the batched hits as recent uses
+        if not self.pending_hits:
+            return
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            uses = self.use_counter(connection)
+            connection.executemany('UPDATE results SET last_used = ? WHERE map_hash = ? AND setup_hash = ? AND program = ?',
+                                   [(uses,) + key for key in self.pending_hits])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.pending_hits = {}
+
+    def evict(self):
+        # drop the least recently used rows past max_entries
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            (num_entries,) = connection.execute('SELECT COUNT(*) FROM results').fetchone()
+            if num_entries > self.max_entries:
+                connection.execute('DELETE FROM results WHERE rowid IN '
+                                   '(SELECT rowid FROM results ORDER BY last_used LIMIT ?)',
+                                   (num_entries - self.max_entries,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        if self.connection is not None and self.connection_pid == os.getpid():
+            self.flush()
+            self.evict()
+            self.connection.close()
+        self.connection = None
+        self.connection_pid = None
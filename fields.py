@@ -0,0 +1,42 @@
+import numpy as np
+
+# exact goal distances, for telling disconnected pairs apart and screening heuristics before A*
+# steps are 8-connected like the A* expansion - a cell's neighbours are the 8 around it, corners included
+
+def distance_fields(maze, goals):
+    # (len(goals), msy, msx) int32 steps from every cell to each (y, x) goal, -1 at walls and unreachable cells
+    # breadth-first from all goals at once, a whole frontier per step, over a stack of padded copies of the map
+    open_cells = np.pad(maze == 0, 1)
+    (padded_msy, padded_msx) = open_cells.shape
+    num_cells = padded_msy * padded_msx
+    # the padding is closed, so a frontier never reaches the next goal's copy
+    open_flat = np.tile(open_cells.ravel(), len(goals))
+    distances = np.full(len(goals) * num_cells, -1, dtype=np.int32)
+    offsets = np.array([-padded_msx-1, -padded_msx, -padded_msx+1, -1, 1, padded_msx-1, padded_msx, padded_msx+1])
+
+    frontier = np.array([i * num_cells + (y + 1) * padded_msx + (x + 1) for (i, (y, x)) in enumerate(goals)], dtype=np.int64)
+    distances[frontier] = 0
+    num_steps = 0
+    while len(frontier):
+        num_steps += 1
+        neighbours = (frontier[:, None] + offsets).ravel()
+        neighbours = np.unique(neighbours[open_flat[neighbours] & (distances[neighbours] < 0)])
+        distances[neighbours] = num_steps
+        frontier = neighbours
+    return distances.reshape(len(goals), padded_msy, padded_msx)[:, 1:-1, 1:-1]
+
+def tied_ranks(values):
+    # ranks of a 1d array, tied values sharing their average rank
+    (_, inverse, counts) = np.unique(values, return_inverse=True, return_counts=True)
+    first_ranks = np.cumsum(counts) - counts
+    return (first_ranks + (counts - 1) / 2)[inverse]
+
+def rank_correlation(values, distance_ranks):
+    # spearman correlation of a heuristic's values with precomputed distance ranks - 0 when either is constant
+    value_ranks = tied_ranks(values)
+    value_ranks -= value_ranks.mean()
+    distance_ranks = distance_ranks - distance_ranks.mean()
+    norm = np.sqrt(np.dot(value_ranks, value_ranks) * np.dot(distance_ranks, distance_ranks))
+    if norm == 0:
+        return 0.0
+    return float(np.dot(value_ranks, distance_ranks) / norm)
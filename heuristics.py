@@ -0,0 +1,16 @@
+from dsl import *
+
+# hand-written and previously synthesized heuristics, shared by main.py and bench.py
+dx = Abs(Minus(Var('state_x'), Var('goal_x')))
+dy = Abs(Minus(Var('state_y'), Var('goal_y')))
+
+manhat_heur = Plus(dx, dy)
+manhat_diag_heur = Plus(Max(dx, dy), Times(Num(0.5), Min(dx, dy)))
+
+# best heuristic synthesized for each map
+map_heuristics = {
+    'isound1': Times(Max(Abs(Minus(Var('state_x'), Var('state_y'))), dx), Plus(dy, Abs(Minus(dx, dy)))),
+    'orz302d': Times(Plus(dx, dy), Max(Plus(Var('state_x'), Var('state_x')), Times(Var('state_y'), Minus(Var('goal_x'), Var('state_x'))))),
+    'brc501d': Plus(Max(Minus(Var('goal_x'), Var('state_x')), dy), Max(Minus(Var('goal_x'), Var('state_x')), Abs(Minus(Minus(Var('goal_x'), Var('state_x')), dy)))),
+}
+
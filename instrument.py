@@ -0,0 +1,149 @@
+import sys, json, time, resource, contextlib
+from atomic import atomic_write
+
+# per-phase timers and counters for the evaluator and the search
+# both take a stats object - null_stats (the default) does nothing, run_stats records
+
+class null_timer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class null_stats:
+    enabled = False
+
+    def __init__(self):
+        self.timer_context = null_timer()
+
+    def count(self, name, n=1):
+        pass
+
+    def timer(self, name):
+        return self.timer_context
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+    def maybe_dump(self):
+        pass
+
+    def summary(self):
+        return {}
+
+class phase_timer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.start_time)
+        return False
+
+class run_stats:
+    enabled = True
+
+    def __init__(self, dump_location=None, dump_interval=60):
+        # counters are plain totals, timers are (seconds, calls)
+        self.counters = {}
+        self.timers = {}
+        self.start_time = time.time()
+        # summary written here every dump_interval seconds (checked by maybe_dump), and by dump
+        self.dump_location = dump_location
+        self.dump_interval = dump_interval
+        self.last_dump_time = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        return phase_timer(self, name)
+
+    def add_time(self, name, seconds):
+        (total, calls) = self.timers.get(name, (0.0, 0))
+        self.timers[name] = (total + seconds, calls + 1)
+
+    def timed_iter(self, name, iterable):
+        # times each step of a generator, e.g. the enumeration that is interleaved with evaluation
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start_time)
+                return
+            self.add_time(name, time.perf_counter() - start_time)
+            yield item
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'timers': {name: {'seconds': total, 'calls': calls, 'fraction': total / elapsed if elapsed else 0.0}
+                       for (name, (total, calls)) in self.timers.items()},
+        }
+
+    def maybe_dump(self):
+        if self.dump_location is not None and time.time() - self.last_dump_time >= self.dump_interval:
+            self.dump()
+
+    def dump(self, dump_location=None):
+        dump_location = dump_location or self.dump_location
+        with atomic_write(dump_location, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+        self.last_dump_time = time.time()
+
+def rss_bytes():
+    # current resident set size - linux reports it directly, elsewhere the peak so far stands in for it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextlib.contextmanager
+def profiled(profiler='cprofile', output_location=None):
+    # with profiled('cprofile', 'search.prof'): ... - or 'pyinstrument' when it is installed
+    # cProfile writes pstats to output_location, pyinstrument writes html there, both print to stderr without one
+    if profiler == 'cprofile':
+        import cProfile, pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield profile
+        finally:
+            profile.disable()
+            if output_location is not None:
+                profile.dump_stats(output_location)
+            else:
+                pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+    elif profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError('pyinstrument is not installed - pip install pyinstrument, or use cprofile')
+        profile = Profiler()
+        profile.start()
+        try:
+            yield profile
+        finally:
+            profile.stop()
+            if output_location is not None:
+                with open(output_location, 'w') as f:
+                    f.write(profile.output_html())
+            else:
+                sys.stderr.write(profile.output_text(unicode=True))
+    else:
+        raise ValueError(f"unknown profiler {profiler!r}, use 'cprofile' or 'pyinstrument'")
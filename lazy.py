@@ -0,0 +1,28 @@
+from dsl import compile_scalar
+
+# costs worked out cell by cell, only for the cells a search opens (a_star evaluation='lazy')
+# each pair is normalized by the program's value range from interval analysis instead of the exact
+# minimum and maximum of the full grid - a positive scale and offset, so cells keep their order
+# and open costs stay within [0, 1] below the closed (7) and wall (9) values
+
+class lazy_program:
+    def __init__(self, heuristic, goals, ranges, layouts):
+        self.function = compile_scalar(heuristic)
+        # (goal_x, goal_y) and (lo, hi) of each pair
+        self.goals = goals
+        self.ranges = ranges
+        # per orientation of the padded map - flat cell coordinates, and 9 at walls and padding, 0 elsewhere
+        self.layouts = layouts
+
+    def run_costs(self, costs_array_idx, rotated):
+        # (wall costs, cell_cost, padded shape) of one A* run, cells indexed like the flat padded grid
+        (cell_x, cell_y, walls, shape) = self.layouts[rotated]
+        (goal_x, goal_y) = self.goals[costs_array_idx]
+        (lo, hi) = self.ranges[costs_array_idx]
+        scale = 1 / (hi - lo) if hi > lo else 0
+        function = self.function
+
+        def cell_cost(idx):
+            return (function(cell_x[idx], cell_y[idx], goal_x, goal_y) - lo) * scale
+
+        return walls, cell_cost, shape
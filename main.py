@@ -1,12 +1,14 @@
-import time, sys
 from dsl import *
-from a_star import a_star
-from search import prog_search
 
 ### INPUTS
 # A* hyperparameters
 map_name = 'isound1'
 num_pairs = 10
+# reproducibility - seed for the pairs and random tie breaks, and 'random', 'index' or 'g' tie breaking
+seed = None
+tie_break = 'random'
+# (start,goal) pairs are loaded from here if it exists, otherwise generated and saved here
+pairs_location = None
 # GBUS hyperparameters
 bound = 0
 performance_type = 'zero'
@@ -15,6 +17,18 @@ regularization_divisor = 10
 regularization_power = 1.5
 floor_individually = True
 compare_normalized_costs = True
+# parallel evaluation
+num_workers = 1
+chunk_size = 16
+# checkpointing - saved after every size level, resume picks up from the last one
+checkpoint_location = None
+resume = False
+# instrumentation - per-phase timers and counters dumped as json every stats_interval seconds,
+# and the search run under 'cprofile' or 'pyinstrument' (written to profile_location, or printed)
+stats_location = None
+stats_interval = 60
+profiler = None
+profile_location = None
 # TEST
 test_more_pairs = False
 show_test_graphs = False
@@ -25,54 +39,19 @@ grammar_constants = [Var('state_x'), Var('state_y'),
                      Var('goal_x'), Var('goal_y'),
                      Num(0.5), Num(2)]
 
-### PRE-COMPUTES
-map_file_location = f'dao-map/{map_name}.map'
-
-### OUTPUTS
-# generate A* evaluator
-evaluator = a_star(num_pairs)
-evaluator.load_map_from_file(map_file_location, show_graphs=True)
-evaluator.generate_start_goal_lists()
-evaluator.additional_gets()
-
-# test if the maze and all (start,goal) pairs are connected
-dx = Abs(Minus(Var('state_x'), Var('goal_x')))
-dy = Abs(Minus(Var('state_y'), Var('goal_y')))
-manhat_heur = Plus(dx, dy)
-manhat_avg_steps, maze_works, _ = evaluator.run_a_star(manhat_heur, update_best=False, show_graphs=show_test_graphs)
-print(f'MANHATTAN: {manhat_avg_steps}')
-
-if maze_works is None:
-    print('Broken maze!')
-    sys.exit()
-
-manhat_diag_heur = Plus(Max(dx, dy), Times(Num(0.5), Min(dx, dy)))
-manhat_diag_avg_steps, _, _ = evaluator.run_a_star(manhat_diag_heur, update_best=False, show_graphs=show_test_graphs)
-print(f'MANHATTAN DIAGONAL: {manhat_diag_avg_steps}')
-
-### TEST PAIRS
-if test_more_pairs:
-    assert map_name in ['isound1', 'orz302d', 'brc501d']
-    if map_name == 'isound1':
-        test_heuristic = Times(Max(Abs(Minus(Var('state_x'), Var('state_y'))), dx), Plus(dy, Abs(Minus(dx, dy))))
-    elif map_name == 'orz302d':
-        test_heuristic = Times(Plus(dx, dy), Max(Plus(Var('state_x'), Var('state_x')), Times(Var('state_y'), Minus(Var('goal_x'), Var('state_x')))))
-    elif map_name == 'brc501d':
-        test_heuristic = Plus(Max(Minus(Var('goal_x'), Var('state_x')), dy), Max(Minus(Var('goal_x'), Var('state_x')), Abs(Minus(Minus(Var('goal_x'), Var('state_x')), dy))))
-    print(map_name)
-    print(test_heuristic.toString())
-    test_heur_avg_steps, _, _ = evaluator.run_a_star(test_heuristic, update_best=False, show_graphs=show_test_graphs)
-    print(f"Best heuristic synthesized for map '{map_name}': {test_heur_avg_steps}")
-
-# sleep for tqdm
-time.sleep(1)
-
-# run bottom-up search
-synthesizer = prog_search(bound, grammar_constants, evaluator)
-synthesizer.initialize_hyperparameters(performance_type, performance_log_base,
-                                       regularization_divisor, regularization_power,
-                                       floor_individually, compare_normalized_costs)
-synthesizer.search()
-
-# evaulate best program
-_, _, _ = evaluator.run_a_star(synthesizer.best_program, update_best=False, show_graphs=True)
\ No newline at end of file
+# the same run from the command line, headless unless --show-graphs:
+#   python -m astar_progsynth search --maps isound1 --bound 5
+if __name__ == '__main__':
+    from astar_progsynth import default_config, run_search
+    config = dict(default_config,
+                  map_name=map_name, num_pairs=num_pairs, seed=seed, tie_break=tie_break, pairs_location=pairs_location,
+                  bound=bound, performance_type=performance_type, performance_log_base=performance_log_base,
+                  regularization_divisor=regularization_divisor, regularization_power=regularization_power,
+                  floor_individually=floor_individually, compare_normalized_costs=compare_normalized_costs,
+                  num_workers=num_workers, chunk_size=chunk_size,
+                  checkpoint_location=checkpoint_location, resume=resume,
+                  stats_location=stats_location, stats_interval=stats_interval,
+                  profiler=profiler, profile_location=profile_location,
+                  test_more_pairs=test_more_pairs, show_graphs=True, show_test_graphs=show_test_graphs,
+                  grammar=[grammar_constant.toString() for grammar_constant in grammar_constants])
+    run_search(config)
@@ -0,0 +1,104 @@
+import os, sys, json
+import numpy as np
+from atomic import atomic_write
+
+# MovingAI terrain - 0 passable, 1 blocked
+# '.' 'G' ground and 'S' swamp are passable, '@' 'O' out of bounds and 'T' trees are blocked
+# 'W' water can only be entered from water, which a binary maze cannot express, so it is blocked
+terrain_values = {'.': 0, 'G': 0, 'S': 0, '@': 1, 'O': 1, 'T': 1, 'W': 1}
+unknown_terrain = 255
+terrain_table = np.full(256, unknown_terrain, dtype=np.uint8)
+for (char, value) in terrain_values.items():
+    terrain_table[ord(char)] = value
+
+# bump when the cached layout changes, so older caches are rebuilt
+map_cache_version = 1
+
+def parse_map(map_file_location):
+    # (header, uint8 maze) of a MovingAI .map file
+    with open(map_file_location, 'rb') as f:
+        lines = f.read().splitlines()
+
+    header = {}
+    for (i, line) in enumerate(lines):
+        words = line.decode('ascii').split()
+        if words == ['map']:
+            break
+        if len(words) == 2:
+            header[words[0]] = words[1]
+    else:
+        raise ValueError(f'{map_file_location}: no "map" line')
+    msy = int(header['height'])
+    msx = int(header['width'])
+
+    rows = [line.rstrip() for line in lines[i+1:i+1+msy]]
+    if len(rows) != msy or any(len(row) != msx for row in rows):
+        raise ValueError(f'{map_file_location}: expected {msy} rows of width {msx}')
+
+    # one table lookup for the whole grid instead of a replace pass per character
+    maze = terrain_table[np.frombuffer(b''.join(rows), dtype=np.uint8)].reshape((msy, msx))
+    if np.any(maze == unknown_terrain):
+        (y, x) = np.argwhere(maze == unknown_terrain)[0]
+        raise ValueError(f'{map_file_location}: unknown terrain {chr(rows[y][x])!r} at ({y}, {x})')
+
+    header['height'] = msy
+    header['width'] = msx
+    return (header, maze)
+
+def map_cache_locations(map_file_location):
+    # the maze as a .npy next to the map, with the header in a .json sidecar
+    return (map_file_location + '.npy', map_file_location + '.json')
+
+def source_stamp(map_file_location):
+    stat = os.stat(map_file_location)
+    return {'version': map_cache_version, 'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+def convert_map(map_file_location):
+    # parse the map and write its cache, replacing files atomically so concurrent loaders never see half a cache
+    (header, maze) = parse_map(map_file_location)
+    (npy_location, json_location) = map_cache_locations(map_file_location)
+    sidecar = dict(header, **source_stamp(map_file_location))
+
+    with atomic_write(npy_location) as f:
+        np.save(f, maze)
+    with atomic_write(json_location, 'w') as f:
+        json.dump(sidecar, f, indent=1)
+    return (sidecar, maze)
+
+def read_map_cache(map_file_location):
+    # (header, read-only memory mapped maze), or None if there is no cache or the map changed since
+    (npy_location, json_location) = map_cache_locations(map_file_location)
+    try:
+        with open(json_location, 'r') as f:
+            sidecar = json.load(f)
+        maze = np.load(npy_location, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    stamp = source_stamp(map_file_location)
+    if any(sidecar.get(key) != value for (key, value) in stamp.items()):
+        return None
+    if maze.shape != (sidecar['height'], sidecar['width']) or maze.dtype != np.uint8:
+        return None
+    return (sidecar, maze)
+
+def load_map(map_file_location, use_cache=True):
+    # processes that load the same cached map share its pages
+    if not use_cache:
+        return parse_map(map_file_location)
+    cached = read_map_cache(map_file_location)
+    if cached is None:
+        try:
+            converted = convert_map(map_file_location)
+        except OSError:
+            # no writing next to the map (read-only or shared dataset mounts) - parsed every time, not mapped
+            return parse_map(map_file_location)
+        # falls back to the parsed maze if another process replaced the cache in between
+        cached = read_map_cache(map_file_location) or converted
+    return cached
+
+if __name__ == '__main__':
+    # python maps.py dao-map/*.map - converts ahead of time
+    for map_file_location in sys.argv[1:]:
+        (header, maze) = convert_map(map_file_location)
+        print(f'{map_file_location}: {header["height"]}x{header["width"]}, {int(np.sum(maze == 0))} open cells')
@@ -1,14 +1,65 @@
-import sys, time, math, copy
+import os, sys, time, math, signal
+import itertools
+import multiprocessing as mp
+import numpy as np
 from dsl import *
 from tqdm import tqdm
 from a_star import a_star
+from bank import program_bank, PLUS, MINUS, TIMES, MAX, MIN, abs_offset
+from checkpoint import encode_programs, decode_programs, save_checkpoint, load_checkpoint
+
+# evaluator, shared best score and the best program's cumulative run steps (for racing) of each worker process
+worker_evaluator = None
+worker_best_avg_steps = None
+worker_best_run_totals = None
+
+def init_worker(evaluator, shared_best_avg_steps, shared_best_run_totals):
+    # runs once per worker - the maze, state matrices and pairs arrive with the evaluator
+    global worker_evaluator, worker_best_avg_steps, worker_best_run_totals
+    worker_evaluator = evaluator
+    # ctrl-c reaches the whole process group - the parent stops the pool, rather than every worker raising mid-run
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # random tie breaks in workers depend on which worker gets which program, so each draws fresh entropy
+    # tie_break='index' or 'g' keeps parallel results reproducible
+    worker_evaluator.rng = np.random.default_rng()
+    worker_best_avg_steps = shared_best_avg_steps
+    worker_best_run_totals = shared_best_run_totals
+
+def costs_key_in_worker(task):
+    # the first half of evaluate_in_worker - the parent checks the key for duplicates before sending the program back
+    (heuristic, compare_normalized_costs, _) = task
+    return worker_evaluator.program_costs_key(heuristic, compare_normalized_costs)
+
+def evaluate_in_worker(task):
+    (heuristic, compare_normalized_costs, best_avg_steps) = task
+    # the cutoff the task was sent with (server.eval_server), or the latest shared best so the cutoff keeps
+    # working across workers
+    if best_avg_steps is None:
+        best_avg_steps = worker_best_avg_steps.value
+    worker_evaluator.best_avg_steps = best_avg_steps
+    worker_evaluator.best_avg_steps_not_inf = best_avg_steps != float('inf')
+    if worker_evaluator.racing_checks and worker_evaluator.best_avg_steps_not_inf:
+        worker_evaluator.best_run_totals = worker_best_run_totals[:]
+    return worker_evaluator.evaluate_pairs(heuristic, compare_normalized_costs)
 
 class prog_search:
-    def __init__(self, bound, grammar_constants, evaluator):
+    def __init__(self, bound, grammar_constants, evaluator, num_workers=1, chunk_size=16, checkpoint_location=None,
+                 stats=None, show_progress=True, result_store=None):
         # selfs
         self.bound = bound
         self.grammar_constants = grammar_constants
         self.evaluator = evaluator
+        # parallel evaluation - num_workers=1 evaluates in this process
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        # saved after every completed size level when set
+        self.checkpoint_location = checkpoint_location
+        # timers and counters - shared with the evaluator unless given separately
+        self.stats = stats if stats is not None else evaluator.stats
+        # tqdm progress bars on stderr
+        self.show_progress = show_progress
+        # results shared with other searches on the same map and pairs (sweep.result_store, server.eval_client)
+        self.result_store = result_store
     
     def initialize_hyperparameters(self, performance_type, performance_log_base,
                                    regularization_divisor, regularization_power,
@@ -21,155 +72,412 @@ class prog_search:
         self.floor_individually = floor_individually
         self.compare_normalized_costs = compare_normalized_costs
     
-    def search(self):
-        # best average number of steps
-        self.best_avg_steps = float('inf')
-        self.best_avg_steps_upon_last_reset = float('inf')
+    def search(self, resume=False):
+        # resume continues from the checkpoint's last completed size level, if there is a checkpoint
+        for _ in self.search_levels(resume):
+            pass
+    
+    def search_levels(self, resume=False):
+        # the search one size level at a time - yields the level just finished,
+        # so several searches can take turns in one process (sweep.run_sweep)
+        if resume and self.checkpoint_location is not None and os.path.exists(self.checkpoint_location):
+            self.restore_checkpoint()
+            print(f'RESUMED AT SIZE: {self.current_size}')
+        else:
+            # best average number of steps, and the program - None until one finishes every pair
+            self.best_avg_steps = float('inf')
+            self.best_avg_steps_upon_last_reset = float('inf')
+            self.best_program = None
+            
+            # the plist - stored programs as rows, grouped by mod_size
+            self.bank = program_bank()
+            for grammar_constant in self.grammar_constants:
+                idx = self.bank.add_node(grammar_constant)
+                # a constant given twice would make the same programs twice
+                if 1 not in self.bank.groups or idx not in self.bank.group(1):
+                    self.bank.group_append(1, idx)
+            
+            # (size1, size2) -> group counts of both sizes when that pair of groups was last enumerated
+            # groups only grow, so every combination of rows below those counts has been evaluated
+            self.watermarks = {}
+            self.heuristics_evaluated = 0
+                    
+            # the main search
+            self.current_size = 0
+            self.reset_size = False
         
-        # both plists
-        self.plist = {}
-        self.plist[1] = self.grammar_constants
+        # worker pool for parallel evaluation
+        pool = None
+        shared_best_avg_steps = None
+        shared_best_run_totals = None
+        if self.num_workers > 1 and self.result_store is not None:
+            raise ValueError('a shared result store evaluates in this process, use num_workers=1')
+        if self.num_workers > 1:
+            shared_best_avg_steps = mp.Value('d', self.evaluator.best_avg_steps)
+            num_runs = len(self.evaluator.pair_runs())
+            shared_best_run_totals = mp.Array('d', self.evaluator.best_run_totals or [0.0] * num_runs)
+            worker_evaluator = self.evaluator.copy_for_worker()
+            pool = mp.Pool(self.num_workers, initializer=init_worker,
+                           initargs=(worker_evaluator, shared_best_avg_steps, shared_best_run_totals))
         
-        # check which programs have been evaulated
-        self.progs_evaled = set()
-                
-        # the main search
-        self.current_size = 0
-        self.reset_size = False
         while self.current_size < self.bound:
             
             self.current_size += 1
             print(f'SIZE: {self.current_size}')
             
-            current_plist = copy.deepcopy(self.plist)
-            self.get_valid_program_sizes(current_plist)
-            prog_generator = self.generate_new_programs(current_plist)
-            for new_heuristic in tqdm(prog_generator, total=self.total_new_programs):
-                if new_heuristic.toString() not in self.progs_evaled:
-                    self.progs_evaled.add(new_heuristic.toString())
-                    avg_steps, add_to_plist, num_iters = self.evaluator.run_a_star(new_heuristic,
-                                                                                   compare_normalized_costs=self.compare_normalized_costs)
-                    if add_to_plist:
-                        '''
-                        this mod_size is probably the most important thing
-                        it determines what cost each program is given
-                        there is a linear and exponential version currently
-                        linear: (* x) is the hyperparameter
-                            [x is the iteration split - e.g. 5 means it is split into 20% tiers]
-                            higher x means higher costs
-                            lower x means lower costs
-                        exponential: (, x) is the hyperparameter
-                            [x is the base of the logarithm]
-                            higher x means higher costs
-                            lower x means lower costs
-                            + epsilon used to be outside of brackets
-                                this would cause costs of 0
-                                maybe this worked better?
-                            changed to add 1 to top and bottom
-                        '''
-                        ### CAN FLOOR BOTH INDIVIDUALLY, OR AT THE END
-                        #performance_size = (self.evaluator.num_pairs - num_iters) * 5 // self.evaluator.num_pairs + 1
-                        if self.performance_type == 'zero':
-                            performance_size = math.log(num_iters / self.evaluator.num_pairs + 1e-4, self.performance_log_base)
-                        elif self.performance_type == 'one':
-                            performance_size = math.log((num_iters + 1) / (self.evaluator.num_pairs + 1), self.performance_log_base)
-                        
-                        # regularization - higher size for longer programs
-                        # can change // x to some other value
-                        true_heuristic_size = new_heuristic.getSize()
-                        #regularization_size = 0
-                        #regularization_size = mod_size + true_heuristic_size // 10
-                        regularization_size = (true_heuristic_size / self.regularization_divisor)**self.regularization_power
-                        if self.floor_individually:
-                            performance_size = performance_size // 1
-                            regularization_size = regularization_size // 1
-                        mod_size = (performance_size + regularization_size + 1) // 1
-                        # make it so size can't exceed real size
-                        mod_size = min(mod_size, true_heuristic_size)
-                        
-                        # make sure mod_size is 1 or greater
-                        if mod_size < 0: # 1
-                            print('INVALID MOD SIZE')
-                            sys.exit()
-                        
-                        # debug check if abs(state_y - goal_y) is size 1
-                        if new_heuristic.toString() in ['abs((state_y - goal_y))',
-                                                        'abs((goal_y - state_y))']:
-                            print('YYYYYYYYYYYYYYYYYYYYYYYYYYYY')
-                            print(f'MOD SIZE: {mod_size}')
-                            print('YYYYYYYYYYYYYYYYYYYYYYYYYYYY')
-                        
-                        if mod_size not in self.plist.keys():
-                            self.plist[mod_size] = []
-                        self.plist[mod_size].append(new_heuristic)       
-                        '''
-                        if mod_size < self.current_size:
-                            self.reset_size = True
-                        '''
-                    if avg_steps < self.best_avg_steps:
-                        # changed reset to when a new best is found
-                        # not only when a lower cost program is generated
-                        ### could only reset when the decrease in steps
-                        ### is a certain amount - such as 5% ???
-                        ### compare to best upon last reset, not current best
-                        ### could be a bunch of incremental <5% increases
-                        if avg_steps / self.best_avg_steps_upon_last_reset <= 0.95:
-                            self.reset_size = True
-                        
-                        # update best program
-                        print('\nNEW BEST FOUND:')
-                        print(new_heuristic.toString())
-                        print(avg_steps)
-                        self.best_avg_steps = avg_steps
-                        self.best_program = new_heuristic
+            # programs added during this level are past these counts
+            current_counts = self.bank.group_counts()
+            self.get_valid_program_sizes(current_counts)
+            prog_generator = self.stats.timed_iter('enumerate', self.generate_new_programs(current_counts))
+            if self.num_workers > 1:
+                self.evaluate_parallel(prog_generator, pool, shared_best_avg_steps, shared_best_run_totals)
+            elif getattr(self.result_store, 'window_size', 1) > 1:
+                self.evaluate_windowed(prog_generator)
+            else:
+                for new_program in tqdm(prog_generator, total=self.total_new_programs, disable=not self.show_progress):
+                    self.stats.count('generated')
+                    self.heuristics_evaluated += 1
+                    new_heuristic = self.build_heuristic(new_program)
+                    avg_steps, add_to_plist, num_iters = self.evaluate_program(new_heuristic)
+                    self.add_result(new_program, new_heuristic, avg_steps, add_to_plist, num_iters)
+                    self.stats.maybe_dump()
             
             # WHETHER THIS IS AT START OR END MATTERS
             if self.reset_size:
                 self.reset_size = False
                 self.current_size = 0
                 self.best_avg_steps_upon_last_reset = self.best_avg_steps
+            
+            if self.checkpoint_location is not None:
+                self.save_checkpoint()
+            yield self.current_size
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.stats.enabled and self.stats.dump_location is not None:
+            self.stats.dump()
     
-    def get_valid_program_sizes(self, prog_dict):
+    def evaluate_parallel(self, prog_generator, pool, shared_best_avg_steps, shared_best_run_totals):
+        # workers work out each program's costs key, this process checks them for duplicates in order, and only
+        # programs new to the search go back to the workers for A* - the bookkeeping stays here, in order
+        progress_bar = tqdm(total=self.total_new_programs, disable=not self.show_progress)
+        new_programs = self.count_generated(prog_generator, progress_bar)
+        # feed the pool a window at a time so the generator isn't drained into its queue
+        window_size = self.num_workers * self.chunk_size * 4
+        while True:
+            window = list(itertools.islice(new_programs, window_size))
+            if not window:
+                break
+            new_heuristics = [self.build_heuristic(new_program) for new_program in window]
+            tasks = [(new_heuristic, self.compare_normalized_costs, None) for new_heuristic in new_heuristics]
+            costs_keys = pool.map(costs_key_in_worker, tasks, chunksize=self.window_chunk_size(len(tasks)))
+            is_new = []
+            for costs_key in costs_keys:
+                if costs_key is None:
+                    self.stats.count('rejected_in_worker')
+                is_new.append(costs_key is not None and not self.evaluator.is_duplicate_costs(costs_key))
+            new_tasks = [task for (task, new) in zip(tasks, is_new) if new]
+            results = pool.imap(evaluate_in_worker, new_tasks, chunksize=self.window_chunk_size(len(new_tasks)))
+            for new_program, new_heuristic, new in zip(window, new_heuristics, is_new):
+                self.heuristics_evaluated += 1
+                result = next(results) if new else None
+                if result is None:
+                    avg_steps, add_to_plist, num_iters = float('inf'), False, None
+                else:
+                    (_, pair_steps) = result
+                    self.evaluator.count_expansions(pair_steps)
+                    self.evaluator.count_outcome(pair_steps)
+                    avg_steps, add_to_plist, num_iters = self.evaluator.score_pair_steps(pair_steps)
+                    if self.evaluator.best_avg_steps != shared_best_avg_steps.value:
+                        # totals first, so a worker that sees the new best also sees its runs
+                        shared_best_run_totals[:] = self.evaluator.best_run_totals
+                        shared_best_avg_steps.value = self.evaluator.best_avg_steps
+                self.add_result(new_program, new_heuristic, avg_steps, add_to_plist, num_iters)
+                self.stats.maybe_dump()
+        progress_bar.close()
+    
+    def window_chunk_size(self, num_tasks):
+        # chunk_size, or smaller so a short list still reaches every worker
+        return max(1, min(self.chunk_size, num_tasks // self.num_workers))
+    
+    def evaluate_windowed(self, prog_generator):
+        # a window of programs at a time to a result store that evaluates elsewhere (server.eval_client),
+        # so they are in flight together - scored and added in order, like evaluate_parallel
+        progress_bar = tqdm(total=self.total_new_programs, disable=not self.show_progress)
+        new_programs = self.count_generated(prog_generator, progress_bar)
+        while True:
+            window = list(itertools.islice(new_programs, self.result_store.window_size))
+            if not window:
+                break
+            new_heuristics = [self.build_heuristic(new_program) for new_program in window]
+            results = self.result_store.evaluate_window(self.evaluator, new_heuristics)
+            for new_program, new_heuristic, (avg_steps, add_to_plist, num_iters) in zip(window, new_heuristics, results):
+                self.heuristics_evaluated += 1
+                self.add_result(new_program, new_heuristic, avg_steps, add_to_plist, num_iters)
+                self.stats.maybe_dump()
+        progress_bar.close()
+    
+    def evaluate_program(self, new_heuristic):
+        # (avg_steps, add_to_plist, num_iters), through the shared result store when there is one
+        if self.result_store is not None:
+            return self.result_store.evaluate(self.evaluator, new_heuristic)
+        return self.evaluator.run_a_star(new_heuristic, compare_normalized_costs=self.compare_normalized_costs)
+    
+    def count_generated(self, prog_generator, progress_bar):
+        for new_program in prog_generator:
+            progress_bar.update()
+            self.stats.count('generated')
+            yield new_program
+    
+    def build_heuristic(self, new_program):
+        (opcode, left, right) = new_program
+        return self.bank.compose(opcode, self.bank.node(left), self.bank.node(right))
+    
+    def save_checkpoint(self):
+        best_program = getattr(self, 'best_program', None)
+        (table, _) = encode_programs([best_program] if best_program is not None else [])
+        save_checkpoint(self.checkpoint_location, {
+            'bank': self.bank.state(),
+            'programs': table,
+            'best_avg_steps': self.best_avg_steps,
+            'best_avg_steps_upon_last_reset': self.best_avg_steps_upon_last_reset,
+            'watermarks': self.watermarks,
+            'heuristics_evaluated': self.heuristics_evaluated,
+            'current_size': self.current_size,
+            'reset_size': self.reset_size,
+            'evaluator': self.evaluator.checkpoint_state(),
+        })
+    
+    def restore_checkpoint(self):
+        state = load_checkpoint(self.checkpoint_location)
+        self.bank = program_bank.from_state(state['bank'])
+        nodes = decode_programs(state['programs'])
+        self.best_program = nodes[-1] if nodes else None
+        self.best_avg_steps = state['best_avg_steps']
+        self.best_avg_steps_upon_last_reset = state['best_avg_steps_upon_last_reset']
+        self.watermarks = state['watermarks']
+        self.heuristics_evaluated = state['heuristics_evaluated']
+        self.current_size = state['current_size']
+        self.reset_size = state['reset_size']
+        self.evaluator.restore_checkpoint_state(state['evaluator'])
+    
+    def add_result(self, new_program, new_heuristic, avg_steps, add_to_plist, num_iters):
+        # (row id, mod_size) of the program when it was stored, or None
+        stored = None
+        if add_to_plist:
+            '''
+            this mod_size is probably the most important thing
+            it determines what cost each program is given
+            there is a linear and exponential version currently
+            linear: (* x) is the hyperparameter
+                [x is the iteration split - e.g. 5 means it is split into 20% tiers]
+                higher x means higher costs
+                lower x means lower costs
+            exponential: (, x) is the hyperparameter
+                [x is the base of the logarithm]
+                higher x means higher costs
+                lower x means lower costs
+                + epsilon used to be outside of brackets
+                    this would cause costs of 0
+                    maybe this worked better?
+                changed to add 1 to top and bottom
+            '''
+            ### CAN FLOOR BOTH INDIVIDUALLY, OR AT THE END
+            #performance_size = (self.evaluator.num_pairs - num_iters) * 5 // self.evaluator.num_pairs + 1
+            if self.performance_type == 'zero':
+                performance_size = math.log(num_iters / self.evaluator.num_pairs + 1e-4, self.performance_log_base)
+            elif self.performance_type == 'one':
+                performance_size = math.log((num_iters + 1) / (self.evaluator.num_pairs + 1), self.performance_log_base)
+
+            # regularization - higher size for longer programs
+            # can change // x to some other value
+            true_heuristic_size = new_heuristic.getSize()
+            #regularization_size = 0
+            #regularization_size = mod_size + true_heuristic_size // 10
+            regularization_size = (true_heuristic_size / self.regularization_divisor)**self.regularization_power
+            if self.floor_individually:
+                performance_size = performance_size // 1
+                regularization_size = regularization_size // 1
+            mod_size = (performance_size + regularization_size + 1) // 1
+            # make it so size can't exceed real size
+            mod_size = min(mod_size, true_heuristic_size)
+
+            # make sure mod_size is 1 or greater
+            if mod_size < 0: # 1
+                print('INVALID MOD SIZE')
+                sys.exit()
+
+            # debug check if abs(state_y - goal_y) is size 1
+            if new_heuristic.toString() in ['abs((state_y - goal_y))',
+                                            'abs((goal_y - state_y))']:
+                print('YYYYYYYYYYYYYYYYYYYYYYYYYYYY')
+                print(f'MOD SIZE: {mod_size}')
+                print('YYYYYYYYYYYYYYYYYYYYYYYYYYYY')
+
+            (opcode, left, right) = new_program
+            idx = self.bank.add(new_heuristic, opcode, left, right, avg_steps)
+            self.bank.group_append(mod_size, idx)
+            stored = (idx, mod_size)
+            '''
+            if mod_size < self.current_size:
+                self.reset_size = True
+            '''
+        if avg_steps < self.best_avg_steps:
+            # changed reset to when a new best is found
+            # not only when a lower cost program is generated
+            ### could only reset when the decrease in steps
+            ### is a certain amount - such as 5% ???
+            ### compare to best upon last reset, not current best
+            ### could be a bunch of incremental <5% increases
+            if avg_steps / self.best_avg_steps_upon_last_reset <= 0.95:
+                self.reset_size = True
+
+            # update best program
+            print('\nNEW BEST FOUND:')
+            print(new_heuristic.toString())
+            print(avg_steps)
+            self.best_avg_steps = avg_steps
+            self.best_program = new_heuristic
+        return stored
+
+    def get_valid_program_sizes(self, group_counts):
         ### lists
         # plus, minus, times, maximum, minimum
         valid_sizes_set = set()
         valid_sizes_list = []
         
         ### valid program sizes
-        for size1 in prog_dict.keys():
-            for size2 in prog_dict.keys():
+        for size1 in group_counts.keys():
+            for size2 in group_counts.keys():
                 if size1 + size2 + 1 == self.current_size:
                     new_valid_size = tuple(sorted((size1, size2)))
                     if new_valid_size not in valid_sizes_set:
                         valid_sizes_set.add(new_valid_size)
                         valid_sizes_list.append(new_valid_size)
         
-        total_new_programs = 0
-        for (size1, size2) in valid_sizes_list:
-            total_new_programs += len(prog_dict[size1]) * len(prog_dict[size2]) * 11
-        
         self.valid_sizes_list = valid_sizes_list
-        self.total_new_programs = total_new_programs
+        self.total_new_programs = self.count_new_programs(group_counts)
+    
+    def program_flags(self, group_counts, size):
+        # (row id, non-negative, constant) for every stored program of one size
+        ids = self.bank.group(size, group_counts[size])
+        return zip(ids.tolist(), self.bank.nonneg[ids].tolist(), self.bank.const[ids].tolist())
+    
+    def pair_program_count(self, flags1, flags2):
+        # number of programs generate_new_programs yields for two different programs
+        (_, nonneg1, const1) = flags1
+        (_, nonneg2, const2) = flags2
+        if const1 and const2:
+            return 0
+        # plus, minus (three), times, max, min - abs only where the inner value can be negative
+        return 7 + (not (nonneg1 and nonneg2)) * 3 + (not (nonneg1 or nonneg2))
     
-    def generate_new_programs(self, prog_dict):
+    def same_program_count(self, flags):
+        # number of programs generate_new_programs yields for a program with itself
+        (_, nonneg, const) = flags
+        if const:
+            return 0
+        return 1 + (not nonneg)
+    
+    def count_new_programs(self, group_counts):
+        # programs of the current rows less those of the rows at each watermark - the old rows' combinations are a subset
+        total_new_programs = 0
+        for (size1, size2) in self.valid_sizes_list:
+            total_new_programs += self.count_bucket_programs(size1, size2, group_counts)
+            if (size1, size2) in self.watermarks:
+                (done1, done2) = self.watermarks[(size1, size2)]
+                total_new_programs -= self.count_bucket_programs(size1, size2, {size1: done1, size2: done2})
+        return total_new_programs
+    
+    def count_bucket_programs(self, size1, size2, group_counts):
+        # counted per (non-negative, constant) class, so this stays cheap for large plists
+        total_new_programs = 0
+        classes1 = self.flag_classes(group_counts, size1)
+        classes2 = self.flag_classes(group_counts, size2)
+        for class1, num1 in classes1.items():
+            for class2, num2 in classes2.items():
+                pair_count = self.pair_program_count((None,) + class1, (None,) + class2)
+                if size1 != size2:
+                    total_new_programs += num1 * num2 * pair_count
+                elif class1 == class2:
+                    total_new_programs += num1 * (num1 - 1) // 2 * pair_count
+                    total_new_programs += num1 * self.same_program_count((None,) + class1)
+                elif class1 < class2:
+                    total_new_programs += num1 * num2 * pair_count
+        return total_new_programs
+    
+    def flag_classes(self, group_counts, size):
+        # number of stored programs of one size in each (non-negative, constant) class
+        ids = self.bank.group(size, group_counts[size])
+        class_counts = np.bincount(self.bank.nonneg[ids] * 2 + self.bank.const[ids], minlength=4)
+        return {(bool(c // 2), bool(c % 2)): int(num) for (c, num) in enumerate(class_counts) if num}
+    
+    def generate_new_programs(self, group_counts):
         ### generate programs
         # plus, minus, times, maximum, minimum
+        # commutative operations only once per pair, no abs of values that can't be negative,
+        # and nothing built only from constants
+        # yields (opcode, left, right) rows - nodes are only built for programs that get evaluated
+        # only combinations with a row past the bucket's watermark are new - every operator is applied to
+        # the same row pairs, so one watermark per (size1, size2) covers them all
         for (size1, size2) in self.valid_sizes_list:
-            for s1 in prog_dict[size1]:
-                for s2 in prog_dict[size2]:
-                    # plus
-                    yield Plus(s1, s2)
-                    yield Abs(Plus(s1, s2))
-                    # minus
-                    yield Minus(s1, s2)
-                    yield Minus(s2, s1)
-                    yield Abs(Minus(s1, s2))
-                    # times
-                    yield Times(s1, s2)
-                    yield Abs(Times(s1, s2))
-                    # max
-                    yield Max(s1, s2)
-                    yield Abs(Max(s1, s2))
-                    # min
-                    yield Min(s1, s2)
-                    yield Abs(Min(s1, s2))
\ No newline at end of file
+            (done1, done2) = self.watermarks.get((size1, size2), (0, 0))
+            if (done1, done2) == (group_counts[size1], group_counts[size2]):
+                continue
+            flags_list1 = list(self.program_flags(group_counts, size1))
+            flags_list2 = list(self.program_flags(group_counts, size2))
+            # holding the operand nodes for the pass lets build_heuristic find them instead of rebuilding them
+            self.bank.hold([s for (s, _, _) in flags_list1 + flags_list2])
+            for i, flags1 in enumerate(flags_list1):
+                (s1, nonneg1, const1) = flags1
+                if size1 == size2:
+                    # pairs within one size only in one order
+                    if i >= done1:
+                        yield from self.same_programs(flags1)
+                    start_j = i + 1 if i >= done1 else max(i + 1, done2)
+                else:
+                    start_j = 0 if i >= done1 else done2
+                for flags2 in flags_list2[start_j:]:
+                    yield from self.pair_programs(flags1, flags2)
+            # only once the whole bucket has been yielded
+            self.watermarks[(size1, size2)] = (group_counts[size1], group_counts[size2])
+            self.bank.release()
+    
+    def same_programs(self, flags):
+        # programs of a stored program with itself - times, and abs(plus) in place of abs(s)
+        # plus(s, s) is s up to scale, so it would only be caught by the cost check, if at all
+        (s1, nonneg1, const1) = flags
+        if const1:
+            return
+        if not nonneg1:
+            yield (PLUS + abs_offset, s1, s1)
+        yield (TIMES, s1, s1)
+    
+    def pair_programs(self, flags1, flags2):
+        # programs of two different stored programs, each given as (row id, non-negative, constant)
+        (s1, nonneg1, const1) = flags1
+        (s2, nonneg2, const2) = flags2
+        if const1 and const2:
+            return
+        both_nonneg = nonneg1 and nonneg2
+        # plus
+        yield (PLUS, s1, s2)
+        if not both_nonneg:
+            yield (PLUS + abs_offset, s1, s2)
+        # minus
+        yield (MINUS, s1, s2)
+        yield (MINUS, s2, s1)
+        yield (MINUS + abs_offset, s1, s2)
+        # times
+        yield (TIMES, s1, s2)
+        if not both_nonneg:
+            yield (TIMES + abs_offset, s1, s2)
+        # max
+        yield (MAX, s1, s2)
+        if not (nonneg1 or nonneg2):
+            yield (MAX + abs_offset, s1, s2)
+        # min
+        yield (MIN, s1, s2)
+        if not both_nonneg:
+            yield (MIN + abs_offset, s1, s2)
@@ -0,0 +1,275 @@
+import os, time, signal, threading, queue
+import multiprocessing as mp
+import numpy as np
+from functools import partial
+from multiprocessing.connection import Listener, Client, Pipe, wait
+from sweep import result_store, score_result, is_new_program, evaluator_fingerprint
+from search import init_worker, evaluate_in_worker
+
+# one loaded map and pair set evaluating heuristics for many searches on the same machine
+# (python -m astar_progsynth serve, and server_location in a search's config)
+# clients send programs with their best avg steps - unpickled nodes are interned, so a program two searches
+# ask for is one node here, and a pickled tree loads faster than its text parses. each round the server takes every
+# request that has arrived, answers what a shared result_store holds, and sends each other distinct program once
+# to a pool of num_workers processes, under the highest cutoff asked for - so programs seen before by any search
+# aren't run again, and the cores go to distinct programs. a request for a program already in the pool waits for
+# that run. clients keep a window of programs in flight (eval_client.evaluate_window), the evaluate_pairs result
+# goes back as soon as its batch is done, and the duplicate check and score stay with the client's own
+# evaluator, like the searches of a sweep
+# messages are pickled, so the socket is created readable and writable by its owner only
+
+class eval_server:
+    def __init__(self, evaluator, compare_normalized_costs, address, store_location=None, save_interval=60,
+                 num_workers=1, chunk_size=16):
+        # racing compares against one best program's runs, and requests of different searches are run together
+        if evaluator.racing_rungs:
+            raise ValueError('the evaluation server runs requests of many searches together, use racing_rungs=[]')
+        self.evaluator = evaluator
+        self.store = result_store(evaluator, compare_normalized_costs, store_location)
+        self.address = address
+        # seconds between saves of the store, when it has a location
+        self.save_interval = save_interval
+        self.connections = []
+        # connections that passed the fingerprint check, handed over by the accepting thread
+        self.new_connections = queue.Queue()
+        self.num_clients = 0
+        self.num_requests = 0
+        self.num_coalesced = 0
+        self.stopping = False
+        # num_workers 1 runs the programs in this process, between reads
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.pool = None
+        # program -> [(connection, request id, best avg steps)] waiting on its run in the pool
+        self.running = {}
+        # (runs, results) of finished batches, handed over by the pool's result thread, which wakes the loop
+        # through the pipe
+        self.finished = queue.Queue()
+        (self.wake_receiver, self.wake_sender) = Pipe(duplex=False)
+
+    def serve(self):
+        # answers requests until interrupted or terminated, then saves the store
+        # the pool is started before the accepting thread, so the workers aren't forked with it
+        if self.num_workers > 1:
+            self.pool = mp.Pool(self.num_workers, initializer=init_worker,
+                                initargs=(self.evaluator.copy_for_worker(), None, None))
+        listener = self.listen()
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+        signal.signal(signal.SIGTERM, self.stop)
+        print(f'SERVING {self.address}')
+        last_save = time.monotonic()
+        try:
+            while not self.stopping:
+                while not self.new_connections.empty():
+                    self.connections.append(self.new_connections.get())
+                ready = wait(self.connections + [self.wake_receiver], timeout=0.1)
+                if self.wake_receiver in ready:
+                    ready.remove(self.wake_receiver)
+                    self.finish_runs()
+                requests = self.receive(ready)
+                if requests:
+                    self.answer(requests)
+                if self.store.store_location is not None and time.monotonic() - last_save >= self.save_interval:
+                    self.store.save()
+                    last_save = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # runs still in the pool are dropped - their clients see the connection close
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+            listener.close()
+            for connection in self.connections:
+                connection.close()
+            if self.store.store_location is not None:
+                self.store.save()
+            print(f'SERVED: {self.num_requests} requests from {self.num_clients} clients, '
+                  f'{self.num_coalesced} coalesced, {self.store.hits} store hits, {self.store.misses} evaluated')
+
+    def stop(self, signum, frame):
+        # the round being answered is finished first
+        self.stopping = True
+
+    def listen(self):
+        if os.path.exists(self.address):
+            try:
+                Client(self.address, family='AF_UNIX').close()
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a server that didn't shut down
+                os.unlink(self.address)
+            else:
+                raise ValueError(f'{self.address}: a server is already listening')
+        previous_umask = os.umask(0o177)
+        try:
+            return Listener(self.address, family='AF_UNIX')
+        finally:
+            os.umask(previous_umask)
+
+    def accept(self, listener):
+        # a client first sends the fingerprint of its evaluator, so steps of another map or pair set are never mixed in
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                # the listener was closed
+                return
+            try:
+                (_, fingerprint) = connection.recv()
+                if fingerprint != self.store.fingerprint:
+                    connection.send(('error', 'the server holds a different map, pairs or settings'))
+                    connection.close()
+                    continue
+                connection.send(('ok', None))
+            except (EOFError, OSError):
+                connection.close()
+                continue
+            self.num_clients += 1
+            self.new_connections.put(connection)
+
+    def receive(self, ready):
+        # [(connection, request id, program, best avg steps)] of every message waiting
+        requests = []
+        for connection in ready:
+            try:
+                (_, batch) = connection.recv()
+            except (EOFError, OSError):
+                self.connections.remove(connection)
+                connection.close()
+                continue
+            requests += [(connection,) + request for request in batch]
+        return requests
+
+    def answer(self, requests):
+        self.num_requests += len(requests)
+        waiting = {}
+        for (connection, request_id, heuristic, best_avg_steps) in requests:
+            waiting.setdefault(heuristic, []).append((connection, request_id, best_avg_steps))
+        self.num_coalesced += len(requests) - len(waiting)
+        runs = []
+        for (heuristic, program_requests) in waiting.items():
+            if heuristic in self.running:
+                self.num_coalesced += len(program_requests)
+            self.dispatch(heuristic, program_requests, runs)
+        self.submit(runs)
+
+    def dispatch(self, heuristic, program_requests, runs):
+        # answers the requests from the store, or has them wait on the program's run - a new run is added to runs
+        if heuristic in self.running:
+            # asked again while it runs - checked against the store when it is done, and run again only if
+            # it was cut below one of these cutoffs
+            self.running[heuristic] += program_requests
+            return
+        # the highest cutoff covers every request - each client re-applies its own when it scores the steps
+        best_avg_steps = max(best_avg_steps for (_, _, best_avg_steps) in program_requests)
+        self.evaluator.best_avg_steps = best_avg_steps
+        self.evaluator.best_avg_steps_not_inf = best_avg_steps != float('inf')
+        if self.pool is None:
+            result = self.store.result(self.evaluator, heuristic)
+        else:
+            max_total_steps = self.evaluator.max_total_steps()
+            (found, result) = self.store.cached(heuristic, max_total_steps)
+            if not found:
+                self.running[heuristic] = list(program_requests)
+                runs.append((heuristic, best_avg_steps, max_total_steps))
+                return
+        self.reply(program_requests, result)
+
+    def submit(self, runs):
+        # one batch to the pool, in chunks small enough to keep every worker busy
+        if not runs:
+            return
+        tasks = [(heuristic, self.store.compare_normalized_costs, best_avg_steps) for (heuristic, best_avg_steps, _) in runs]
+        chunk_size = max(1, min(self.chunk_size, len(tasks) // self.num_workers))
+        self.pool.map_async(evaluate_in_worker, tasks, chunk_size,
+                            callback=partial(self.runs_done, runs), error_callback=self.runs_failed)
+
+    def runs_done(self, runs, results):
+        # in the pool's result thread - the loop stores and answers them
+        self.finished.put((runs, results))
+        self.wake_sender.send(None)
+
+    def runs_failed(self, error):
+        self.finished.put((None, error))
+        self.wake_sender.send(None)
+
+    def finish_runs(self):
+        while self.wake_receiver.poll():
+            self.wake_receiver.recv()
+        runs = []
+        while not self.finished.empty():
+            (done, results) = self.finished.get()
+            if done is None:
+                raise results
+            for ((heuristic, _, max_total_steps), result) in zip(done, results):
+                self.store.keep(self.evaluator, heuristic, result, max_total_steps)
+                self.dispatch(heuristic, self.running.pop(heuristic), runs)
+        self.submit(runs)
+
+    def reply(self, program_requests, result):
+        for (connection, request_id, _) in program_requests:
+            try:
+                connection.send(('results', [(request_id, result)]))
+            except OSError:
+                # gone - dropped when its end of the connection is read
+                pass
+
+class eval_client:
+    # stands in for a search's result_store, evaluating through a running eval_server
+    def __init__(self, address, evaluator, compare_normalized_costs, window_size=64):
+        self.address = address
+        self.compare_normalized_costs = compare_normalized_costs
+        # programs a search sends at once through evaluate_window
+        self.window_size = window_size
+        self.connection = Client(address, family='AF_UNIX')
+        self.connection.send(('hello', evaluator_fingerprint(evaluator, compare_normalized_costs)))
+        (status, message) = self.connection.recv()
+        if status != 'ok':
+            self.connection.close()
+            raise ValueError(f'{address}: {message}')
+        self.next_request_id = 0
+        # request id -> result of replies that arrived before they were asked for
+        self.replies = {}
+
+    def evaluate(self, evaluator, heuristic):
+        # what evaluator.run_a_star would return, with the A* runs done by the server
+        # duplicates of the search's earlier programs are turned away here, so the server never queues them
+        if not self.is_new(evaluator, heuristic):
+            return np.inf, False, None
+        return score_result(evaluator, self.result(evaluator, heuristic))
+
+    def evaluate_window(self, evaluator, heuristics):
+        # evaluate for each heuristic, in order, with the new ones sent at once - each is scored against the
+        # evaluator's best when it is reached, so results cut under an older best are cut again
+        is_new = [self.is_new(evaluator, heuristic) for heuristic in heuristics]
+        request_ids = iter(self.send(evaluator, [heuristic for (heuristic, new) in zip(heuristics, is_new) if new]))
+        for new in is_new:
+            yield score_result(evaluator, self.receive(evaluator, next(request_ids))) if new else (np.inf, False, None)
+
+    def is_new(self, evaluator, heuristic):
+        # checked in order, so a window dedups the same way one program at a time would
+        return is_new_program(evaluator, evaluator.program_costs_key(heuristic, self.compare_normalized_costs))
+
+    def result(self, evaluator, heuristic):
+        [request_id] = self.send(evaluator, [heuristic])
+        return self.receive(evaluator, request_id)
+
+    def send(self, evaluator, heuristics):
+        request_ids = range(self.next_request_id, self.next_request_id + len(heuristics))
+        self.next_request_id += len(heuristics)
+        evaluator.stats.count('server_requests', len(heuristics))
+        with evaluator.stats.timer('server'):
+            self.connection.send(('evaluate', [(request_id, heuristic, evaluator.best_avg_steps)
+                                               for (request_id, heuristic) in zip(request_ids, heuristics)]))
+        return request_ids
+
+    def receive(self, evaluator, request_id):
+        # the server answers in the order runs finish, not the order they were sent
+        with evaluator.stats.timer('server'):
+            while request_id not in self.replies:
+                (_, results) = self.connection.recv()
+                self.replies.update(results)
+        return self.replies.pop(request_id)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,158 @@
+import os, pickle, itertools
+import numpy as np
+from search import prog_search
+from atomic import atomic_write
+
+# hyperparameter sweeps - many searches on one map and pair set, sharing the A* work
+# the hyperparameters only change how programs are bucketed into mod sizes, so a program's
+# per-pair steps are the same for every search, and each search rescores them against its own best
+
+# bump when the stored layout changes
+store_version = 3
+
+# settings of prog_search.initialize_hyperparameters that a sweep may vary
+sweep_keys = ['performance_type', 'performance_log_base', 'regularization_divisor', 'regularization_power',
+              'floor_individually']
+
+def evaluator_fingerprint(evaluator, compare_normalized_costs):
+    # everything the steps depend on - the map, the pairs and how costs are built and searched
+    return (evaluator.maze_digest() + evaluator.setup_digest(compare_normalized_costs)).hex()
+
+class result_store:
+    def __init__(self, evaluator, compare_normalized_costs, store_location=None):
+        # random tie breaks give different steps on every run, so there would be nothing to share
+        if evaluator.tie_break == 'random':
+            raise ValueError("shared results need reproducible steps, use tie_break='index' or 'g'")
+        self.compare_normalized_costs = compare_normalized_costs
+        self.fingerprint = evaluator_fingerprint(evaluator, compare_normalized_costs)
+        self.store_location = store_location
+        # program string -> (evaluate_pairs result, step cutoff it ran under)
+        # the result is (costs_key, pair_steps), or None when the program was rejected
+        self.results = {}
+        # program string -> costs key, or None when the program was rejected - worked out once for every search
+        self.costs_keys = {}
+        self.hits = 0
+        self.misses = 0
+        if store_location is not None and os.path.exists(store_location):
+            self.load()
+
+    def evaluate(self, evaluator, heuristic):
+        # what evaluator.run_a_star would return, running A* only when no stored result covers the evaluator's cutoff
+        # duplicates of the evaluator's earlier programs are turned away on their costs, before any A* is run
+        key = heuristic.toString()
+        costs = None
+        if key not in self.costs_keys:
+            (self.costs_keys[key], costs) = evaluator.program_costs(heuristic, self.compare_normalized_costs)
+        if not is_new_program(evaluator, self.costs_keys[key]):
+            return np.inf, False, None
+        return score_result(evaluator, self.result(evaluator, heuristic, costs))
+
+    def result(self, evaluator, heuristic, costs=None):
+        # the evaluate_pairs result of the heuristic under the evaluator's cutoff, stored or run now
+        # costs are the heuristic's from evaluator.program_costs, when they were just worked out
+        max_total_steps = evaluator.max_total_steps()
+        (found, result) = self.cached(heuristic, max_total_steps)
+        if found:
+            evaluator.stats.count('store_hits')
+            return result
+        evaluator.stats.count('store_misses')
+        result = evaluator.evaluate_pairs(heuristic, self.compare_normalized_costs, costs)
+        self.keep(evaluator, heuristic, result, max_total_steps)
+        return result
+
+    def cached(self, heuristic, max_total_steps):
+        # (found, result) - found when the stored result holds for runs cut at max_total_steps
+        entry = self.results.get(heuristic.toString())
+        # a run cut short under a lower cutoff doesn't say what happens past it
+        if entry is None or (entry[0] is not None and entry[0][1][-1][1] in ['cut', 'screened'] and max_total_steps > entry[1]):
+            return (False, None)
+        self.hits += 1
+        return (True, entry[0])
+
+    def keep(self, evaluator, heuristic, result, max_total_steps):
+        # a result evaluated under max_total_steps - runs finishing out of order never replace one of a higher cutoff
+        self.misses += 1
+        # raced results depend on this search's best program, so they aren't shared
+        if evaluator.is_raced(result):
+            return
+        key = heuristic.toString()
+        if key not in self.results or max_total_steps >= self.results[key][1]:
+            self.results[key] = (result, max_total_steps)
+
+    def save(self):
+        with atomic_write(self.store_location) as f:
+            pickle.dump({'version': store_version, 'fingerprint': self.fingerprint, 'results': self.results,
+                         'costs_keys': self.costs_keys}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        with open(self.store_location, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != store_version:
+            raise ValueError(f'{self.store_location}: store version {state.get("version")}, expected {store_version}')
+        if state['fingerprint'] != self.fingerprint:
+            raise ValueError(f'{self.store_location}: results were stored for a different map, pairs or settings')
+        self.results = state['results']
+        self.costs_keys = state['costs_keys']
+
+def is_new_program(evaluator, costs_key):
+    # whether a program with these costs is new to the evaluator's search - None is a rejected program
+    return costs_key is not None and not evaluator.is_duplicate_costs(costs_key)
+
+def score_result(evaluator, result):
+    # (avg_steps, add_to_plist, num_iters) of an evaluate_pairs result, against the evaluator's own best
+    # duplicates are checked before the result is asked for, see is_new_program
+    if result is None:
+        return np.inf, False, None
+    (_, pair_steps) = result
+    evaluator.count_outcome(pair_steps)
+    return evaluator.score_pair_steps(pair_steps)
+
+def expand_grid(grid):
+    # {'regularization_power': [1, 1.5, 2], 'performance_log_base': [0.25, 0.5]} -> one dict per combination
+    unknown = sorted(set(grid) - set(sweep_keys))
+    if unknown:
+        raise ValueError(f'cannot sweep {", ".join(unknown)}, only {", ".join(sweep_keys)}')
+    names = list(grid)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def run_sweep(bound, grammar_constants, evaluator, base_hyperparameters, grid, store_location=None, show_progress=False):
+    # one search per grid point, taking turns a size level at a time against a shared result store
+    # base_hyperparameters holds all of initialize_hyperparameters' settings, grid the ones that vary
+    compare_normalized_costs = base_hyperparameters['compare_normalized_costs']
+    store = result_store(evaluator, compare_normalized_costs, store_location)
+
+    searches = []
+    for point in expand_grid(grid):
+        hyperparameters = dict(base_hyperparameters, **point)
+        # a fresh best, duplicate set and buffers, sharing the maze, state matrices and pairs
+        search_evaluator = evaluator.copy_for_worker()
+        search_evaluator.reset_search_state()
+        search_evaluator.stats = evaluator.stats
+        synthesizer = prog_search(bound, grammar_constants, search_evaluator, show_progress=show_progress,
+                                  result_store=store)
+        synthesizer.initialize_hyperparameters(hyperparameters['performance_type'], hyperparameters['performance_log_base'],
+                                               hyperparameters['regularization_divisor'], hyperparameters['regularization_power'],
+                                               hyperparameters['floor_individually'], compare_normalized_costs)
+        searches.append((point, synthesizer, synthesizer.search_levels()))
+
+    running = list(searches)
+    while running:
+        for (point, synthesizer, levels) in list(running):
+            print(f'SWEEP {point}')
+            if next(levels, None) is None:
+                running.remove((point, synthesizer, levels))
+        if store_location is not None:
+            store.save()
+        print(f'STORE: {len(store.results)} programs, {store.hits} hits, {store.misses} misses')
+
+    results = []
+    for (point, synthesizer, _) in searches:
+        best_program = getattr(synthesizer, 'best_program', None)
+        results.append({
+            'hyperparameters': point,
+            'best_program': best_program.toString() if best_program is not None else None,
+            'best_avg_steps': synthesizer.best_avg_steps if np.isfinite(synthesizer.best_avg_steps) else None,
+            'heuristics_evaluated': synthesizer.heuristics_evaluated,
+        })
+    return (results, store)